@@ -0,0 +1,309 @@
+import time
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+import click
+
+import torch
+
+import epiframework
+import distributed
+import nn_blocks, ddpm, myutils, ground_truth, training_datasets
+import build_dataset
+
+
+image_size = 64
+channels = 1
+batch_size = 512
+epoch = 800
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_trained_spec(checkpoint_fn, unet_name, dataset_name, transform_name):
+    """ Rebuild the (ddpm, dataset) pair of a spec and load the trained weights from `checkpoint_fn`. """
+    gt1 = ground_truth.GroundTruth(season_first_year="2022",
+                                    data_date=datetime.datetime(2022,10,25),
+                                    mask_date=datetime.datetime(2022,10,25),
+                                    channels=channels,
+                                    image_size=image_size,
+                                    nogit=True
+                                )
+    ddpm1 = epiframework.model_libary(image_size=image_size, channels=channels, epoch=epoch, device=device, batch_size=batch_size)[unet_name]
+    dataset = epiframework.dataset_library(gt1=gt1, channels=channels)[dataset_name]
+    scaling_per_channel = epiframework.scaling_per_channel(dataset.max_per_feature, gt1)
+    transforms_spec, transform_enrich = epiframework.transform_library(scaling_per_channel=scaling_per_channel)
+    dataset.add_transform(transform=transforms_spec[transform_name]["reg"],
+                          transform_inv=transforms_spec[transform_name]["inv"],
+                          transform_enrich=transform_enrich["No"],
+                          bypass_test=False)
+    ddpm1.load_model_checkpoint(checkpoint_fn)
+    ddpm1.model.eval()
+    return ddpm1, dataset, gt1
+
+
+def benchmark_sampling_steps(ddpm1, dataset, n_places, steps_list, eta=1.0, n_obs=64):
+    """
+    Sample the model with the full chain and with respaced chains of `steps_list` steps and report the
+    wall time and the mean CRPS of the (inverse transformed) generated ensemble against `n_obs`
+    frames of the training dataset, restricted to the `n_places` real places.
+    """
+    rng = np.random.default_rng(0)
+    obs_idx = rng.choice(len(dataset), size=min(n_obs, len(dataset)), replace=False)
+    obs = dataset.flu_dyn[obs_idx][:, :, :, :n_places]
+
+    results = []
+    for sampling_steps in [None] + list(steps_list):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        tic = time.perf_counter()
+        samples = ddpm1.sample(sampling_steps=sampling_steps, eta=eta)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - tic
+
+        ensemble = dataset.apply_transform_inv(samples[-1])[:, :, :, :n_places]
+        crps = np.mean([myutils.crps_ensemble(ensemble, o).mean() for o in obs])
+        results.append({
+            "sampling_steps": ddpm1.timesteps if sampling_steps is None else sampling_steps,
+            "eta": 1.0 if sampling_steps is None else eta,
+            "seconds": elapsed,
+            "speedup": np.nan,
+            "crps": crps,
+        })
+        print(f">> {results[-1]['sampling_steps']:4} steps: {elapsed:8.2f}s, CRPS {crps:.4f}")
+
+    df = pd.DataFrame(results)
+    df["speedup"] = df["seconds"].iloc[0] / df["seconds"]
+    return df
+
+
+def extract_cpu_gather(a, t, x_shape):
+    """ previous myutils.extract, gathering on the host: kept as the baseline of benchmark_schedule_overhead """
+    batch_size = t.shape[0]
+    out = a.cpu().gather(-1, t.cpu())
+    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
+
+
+def benchmark_schedule_overhead(timesteps=500, batch_size=batch_size, repeats=3):
+    """
+    Time the schedule lookups of one full reverse chain (4 per step, as in DDPM.p_sample), without
+    the Unet forward: host gather (before), on-device gather (myutils.extract on the schedule that
+    DDPM now keeps on device) and the precomputed per-step python floats used while sampling.
+    """
+    ddpm1 = ddpm.DDPM(model=torch.nn.Conv2d(channels, channels, 1), timesteps=timesteps, batch_size=batch_size, device=device)
+    x_shape = (batch_size, channels, image_size, image_size)
+    names = ["betas", "sqrt_one_minus_alphas_cumprod", "sqrt_recip_alphas", "posterior_variance"]
+
+    def lookup_extract(extract_fn):
+        def run():
+            for i in reversed(range(ddpm1.timesteps)):
+                t = torch.full((batch_size,), i, device=device, dtype=torch.long)
+                coefs = [extract_fn(getattr(ddpm1, name), t, x_shape) for name in names]
+            return coefs
+        return run
+
+    def lookup_scalars():
+        for i in reversed(range(ddpm1.timesteps)):
+            coefs = [ddpm1.step_coefficients[i][name] for name in names]
+        return coefs
+
+    methods = {
+        "host gather (before)": lookup_extract(extract_cpu_gather),
+        "device gather": lookup_extract(myutils.extract),
+        "per-step scalars": lookup_scalars,
+    }
+    results = []
+    for method_name, run in methods.items():
+        timings = []
+        for _ in range(repeats):
+            if device == "cuda":
+                torch.cuda.synchronize()
+            tic = time.perf_counter()
+            run()
+            if device == "cuda":
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - tic)
+        per_step_us = 1e6 * min(timings) / ddpm1.timesteps
+        results.append({"method": method_name, "device": device, "us_per_step": per_step_us})
+        print(f">> {method_name:<22} {per_step_us:10.1f} us per reverse step")
+    return pd.DataFrame(results)
+
+
+def check_precision_quantiles(ddpm1, transform_inv, n_places, precision="bf16", sampling_steps=None, tol=0.05, seed=0):
+    """
+    Sample with the same seed in fp32 and in `precision` and compare the flusight quantiles of the
+    ensembles (inverse transformed by `transform_inv`) over the `n_places` real places. The largest
+    deviation is normalized by the fp32 quantile range so `tol` is a fraction of the forecast spread.
+    """
+    quantiles = {}
+    timings = {}
+    for prec in ["fp32", precision]:
+        ddpm1.precision = prec
+        torch.manual_seed(seed)
+        tic = time.perf_counter()
+        samples = ddpm1.sample(sampling_steps=sampling_steps, eta=1.0)
+        timings[prec] = time.perf_counter() - tic
+        ensemble = transform_inv(samples[-1])[:, :, :, :n_places]
+        quantiles[prec] = np.quantile(ensemble, myutils.flusight_quantiles, axis=0)
+    ddpm1.precision = "fp32"
+
+    spread = quantiles["fp32"].max() - quantiles["fp32"].min()
+    deviation = np.abs(quantiles[precision] - quantiles["fp32"]).max() / spread
+    print(f">> {precision} vs fp32: {timings[precision]:.2f}s vs {timings['fp32']:.2f}s, max quantile deviation {deviation:.4f} of the range (tol {tol})")
+    assert deviation < tol, f"{precision} quantiles deviate by {deviation:.4f} > {tol} from fp32"
+    return deviation
+
+
+def small_trained_ddpm(n_frames=64, n_samples=128, epochs=2):
+    """ a small DDPM briefly trained on CPU on random frames, and its dataset, so no trained checkpoint is needed """
+    torch.manual_seed(0)
+    dataset = training_datasets.FluDataset(flu_dyn=np.random.default_rng(0).random((n_frames, 1, 16, 16)), channels=1)
+    ddpm1 = ddpm.DDPM(model=nn_blocks.Unet(dim=16, channels=1, dim_mults=(1, 2), use_convnext=False),
+                      image_size=16, channels=1, batch_size=16, epochs=epochs, timesteps=20, device="cpu")
+    ddpm1.train(dataloader=torch.utils.data.DataLoader(dataset, batch_size=16, shuffle=True, drop_last=True))
+    ddpm1.model.eval()
+    ddpm1.batch_size = n_samples
+    return ddpm1, dataset
+
+
+def check_precision_small(precision="bf16", tol=0.05, n_frames=64, n_samples=128, epochs=2):
+    """ Self-contained check_precision_quantiles on CPU, see small_trained_ddpm """
+    ddpm1, dataset = small_trained_ddpm(n_frames=n_frames, n_samples=n_samples, epochs=epochs)
+    return check_precision_quantiles(ddpm1, transform_inv=dataset.apply_transform_inv, n_places=16, precision=precision, tol=tol)
+
+
+def check_benchmarks_small(n_samples=16):
+    """
+    Smoke run of benchmark_sampling_steps and check_precision_quantiles on a small model (see
+    small_trained_ddpm), so a broken benchmark path fails in seconds. Only checks that they run: the
+    precision tolerance is not asserted.
+    """
+    ddpm1, dataset = small_trained_ddpm(n_samples=n_samples)
+    df = benchmark_sampling_steps(ddpm1, dataset, n_places=16, steps_list=[5], n_obs=4)
+    assert len(df) == 2 and df["crps"].notna().all(), df
+    check_precision_quantiles(ddpm1, transform_inv=dataset.apply_transform_inv, n_places=16, precision="bf16", tol=np.inf)
+    print(">> sampling-steps and precision benchmarks run")
+
+
+def check_distributed_training(rank, world_size, checkpoint_fn, n_frames=64, epochs=2):
+    """
+    Train a small DDPM on random frames in each process of a process group (see distributed.spawn),
+    then check that all ranks hold the same weights and that the rank-0 checkpoint loads in a plain,
+    single-process DDPM.
+    """
+    torch.manual_seed(0)
+    dataset = training_datasets.FluDataset(flu_dyn=np.random.default_rng(0).random((n_frames, 1, 16, 16)), channels=1)
+    dataloader = distributed.distributed_dataloader(dataset, batch_size=16)
+
+    def build():
+        return ddpm.DDPM(model=nn_blocks.Unet(dim=16, channels=1, dim_mults=(1, 2), use_convnext=False),
+                         image_size=16, channels=1, batch_size=16, epochs=epochs, timesteps=20, device="cpu")
+    ddpm1 = build()
+    ddpm1.train(dataloader=dataloader, checkpoint_path=checkpoint_fn)
+
+    weights = torch.cat([p.detach().flatten() for p in ddpm1.model.parameters()])
+    gathered = [torch.zeros_like(weights) for _ in range(world_size)]
+    torch.distributed.all_gather(gathered, weights)
+    assert all(torch.equal(gathered[0], w) for w in gathered), "ranks diverged"
+    if rank == 0:
+        build().load_model_checkpoint(checkpoint_fn)
+        print(f">> {world_size} processes trained {ddpm1.step} steps in sync, the rank-0 checkpoint loads unwrapped")
+
+
+def check_epidata_cache(refetch_weeks=4):
+    """
+    Offline check of the incremental Epidata cache against build_dataset.StubEpidata: a second fetch
+    only requests the newest cached weeks and the new ones, and revised values replace the cached ones.
+    """
+    weeks = [202440 + w for w in range(10)]
+    rng = np.random.default_rng(0)
+    truth = pd.DataFrame([{"region": region, "epiweek": week, "ili": rng.random()} for region in ["ca", "ny"] for week in weeks])
+    with tempfile.TemporaryDirectory() as cache_dir:
+        first = build_dataset.StubEpidata(truth[truth["epiweek"] <= weeks[7]])
+        build_dataset.fetch_epidata("fluview", ["ca", "ny"], client=first, cache_dir=cache_dir, last_epiweek=weeks[-1], refetch_weeks=refetch_weeks)
+
+        revised = truth.copy()
+        revised.loc[revised["epiweek"] == weeks[6], "ili"] += 1  # backfill of a cached week
+        second = build_dataset.StubEpidata(revised)
+        df = build_dataset.fetch_epidata("fluview", ["ca", "ny"], client=second, cache_dir=cache_dir, last_epiweek=weeks[-1], refetch_weeks=refetch_weeks)
+
+    assert all(ranges[0]["from"] == weeks[7 - refetch_weeks + 1] for _, ranges in second.requests), second.requests
+    df = df.sort_values(["region", "epiweek"], ignore_index=True)
+    assert len(df) == len(revised), "missing or duplicated weeks"
+    assert np.allclose(df["ili"], revised.sort_values(["region", "epiweek"], ignore_index=True)["ili"]), "revised values not refreshed"
+    print(f">> incremental epidata cache: {len(second.requests)} requests from {weeks[7 - refetch_weeks + 1]}, revisions refreshed")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("sampling-steps")
+@click.option("-c", "--checkpoint", "checkpoint_fn", type=str, required=True, help="trained checkpoint (.pth) to benchmark")
+@click.option("-m", "--model", "unet_name", type=str, default="MyUnet500", show_default=True, help="name in epiframework.model_libary")
+@click.option("-d", "--dataset", "dataset_name", type=str, default="R1Fv", show_default=True, help="name in epiframework.dataset_library")
+@click.option("-t", "--transform", "transform_name", type=str, default="Sqrt", show_default=True, help="name in epiframework.transform_library")
+@click.option("-s", "--steps", "steps_list", type=int, multiple=True, default=(25, 50, 100), show_default=True, help="respaced step counts to compare to the full chain")
+@click.option("-e", "--eta", "eta", type=float, default=1.0, show_default=True, help="DDIM eta (0: deterministic, 1: ancestral, the default of DDPM.sample)")
+@click.option("-o", "--output", "output_fn", type=str, default="bench_sampling_steps.csv", show_default=True, help="where to write the results")
+def sampling_steps(checkpoint_fn, unet_name, dataset_name, transform_name, steps_list, eta, output_fn):
+    ddpm1, dataset, gt1 = load_trained_spec(checkpoint_fn, unet_name, dataset_name, transform_name)
+    df = benchmark_sampling_steps(ddpm1, dataset, n_places=len(gt1.flusetup.locations), steps_list=steps_list, eta=eta)
+    print(df)
+    df.to_csv(output_fn, index=False)
+
+
+@cli.command("precision")
+@click.option("-c", "--checkpoint", "checkpoint_fn", type=str, required=True, help="trained checkpoint (.pth) to check")
+@click.option("-m", "--model", "unet_name", type=str, default="MyUnet500", show_default=True, help="name in epiframework.model_libary")
+@click.option("-d", "--dataset", "dataset_name", type=str, default="R1Fv", show_default=True, help="name in epiframework.dataset_library")
+@click.option("-t", "--transform", "transform_name", type=str, default="Sqrt", show_default=True, help="name in epiframework.transform_library")
+@click.option("-p", "--precision", "precision", type=click.Choice(["bf16", "fp16"]), default="bf16", show_default=True, help="precision to compare to fp32")
+@click.option("--tol", "tol", type=float, default=0.05, show_default=True, help="tolerated deviation, as a fraction of the quantile range")
+def precision(checkpoint_fn, unet_name, dataset_name, transform_name, precision, tol):
+    ddpm1, dataset, gt1 = load_trained_spec(checkpoint_fn, unet_name, dataset_name, transform_name)
+    check_precision_quantiles(ddpm1, dataset.apply_transform_inv, n_places=len(gt1.flusetup.locations), precision=precision, tol=tol)
+
+
+@cli.command("precision-small")
+@click.option("-p", "--precision", "precision", type=click.Choice(["bf16", "fp16"]), default="bf16", show_default=True, help="precision to compare to fp32")
+@click.option("--tol", "tol", type=float, default=0.05, show_default=True, help="tolerated deviation, as a fraction of the quantile range")
+def precision_small(precision, tol):
+    """ precision check on a small random model on CPU, without a trained checkpoint (e.g in CI) """
+    check_precision_small(precision=precision, tol=tol)
+
+
+@cli.command("smoke")
+def smoke():
+    """ both sampling benchmarks on a small random model on CPU, to catch a broken benchmark path """
+    check_benchmarks_small()
+
+
+@cli.command("schedule-overhead")
+@click.option("-T", "--timesteps", "timesteps", type=int, default=500, show_default=True, help="length of the reverse chain")
+@click.option("-o", "--output", "output_fn", type=str, default="bench_schedule_overhead.csv", show_default=True, help="where to write the results")
+def schedule_overhead(timesteps, output_fn):
+    df = benchmark_schedule_overhead(timesteps=timesteps)
+    print(df)
+    df.to_csv(output_fn, index=False)
+
+
+@cli.command("distributed")
+@click.option("-n", "--processes", "world_size", type=int, default=2, show_default=True, help="number of local processes")
+@click.option("-o", "--output", "checkpoint_fn", type=str, default="ddp_check.pth", show_default=True, help="checkpoint written by rank 0")
+def distributed_check(world_size, checkpoint_fn):
+    """ distributed training on CPU with gloo and local processes """
+    distributed.spawn(check_distributed_training, world_size=world_size, backend="gloo", args=(checkpoint_fn,))
+
+
+@cli.command("epidata-cache")
+def epidata_cache():
+    """ incremental Epidata cache against an offline stub client """
+    check_epidata_cache()
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,7 +1,12 @@
+import io
+import os
+import hashlib
+import concurrent.futures
 import pandas as pd
 import numpy as np
 from helpers.delphi_epidata import Epidata
 from season_setup import SeasonSetup
+import vintages
 import xarray as xr
 import epiweeks
 
@@ -75,26 +80,156 @@ def dataframe_to_xarray(
 def dataframe_to_arraylist(
     df: pd.DataFrame, season_setup: SeasonSetup = None, value_column="value"
 ) -> np.ndarray:
+    """
+    One frame per flu season, as an array (n_seasons, 1, 64, 64): weeks (the distinct
+    `fluseason_fraction` of the season, in order) x places (in the order of season_setup.locations),
+    missing values and padding set to 0. The values are scattered in place using integer codes for
+    the season, week and location of each row.
+    """
+    df = df[df["fluseason"].notna() & df["fluseason_fraction"].notna()]
+    if df.duplicated(subset=["fluseason", "fluseason_fraction", "location_code"]).any():
+        raise ValueError("Index contains duplicate entries, cannot reshape")
 
-    samples = []
+    seasons, season_idx = np.unique(df["fluseason"].to_numpy(), return_inverse=True)
+    # a week exists in a season if any location (even one not in season_setup) has data for it
+    week_idx = df.groupby("fluseason")["fluseason_fraction"].rank(method="dense").to_numpy().astype(int) - 1
+    place_idx = pd.Categorical(df["location_code"], categories=season_setup.locations).codes
+    assert week_idx.max(initial=-1) < 64 and len(season_setup.locations) <= 64, "seasons and locations must fit in 64x64"
 
-    df_piv = df.pivot(
-        columns="location_code",
-        values=value_column,
-        index=["fluseason", "fluseason_fraction"],
-    )
-    for season in df_piv.index.unique(level="fluseason"):
-        array = df_piv.loc[season][
-            season_setup.locations
-        ].to_numpy()  # make sure order is right w.r.t flusight_locations
-        array[np.isnan(array)] = 0  # replace NaNs with 0
-        samples.append(
-            np.array([padto64x64(array)])
-        )  # pad to 64x64 and add a dimension for channel
+    samples = np.zeros((len(seasons), 1, 64, 64))
+    keep = place_idx >= 0
+    samples[season_idx[keep], 0, week_idx[keep], place_idx[keep]] = df[value_column].to_numpy(dtype=float)[keep]
+    samples[np.isnan(samples)] = 0  # replace NaNs with 0
 
     return samples
 
 
+def epiweek_to_enddate(epiweek) -> pd.Series:
+    """
+    Vectorized epiweeks.Week.fromstring(str(ew), system="cdc").enddate() over a column of YYYYWW
+    epiweeks: CDC week 1 is the Sunday-Saturday week that contains January 4th.
+    """
+    epiweek = pd.Series(epiweek).astype(int)
+    jan4 = pd.to_datetime((epiweek // 100).astype(str) + "0104", format="%Y%m%d")
+    week1_start = jan4 - pd.to_timedelta((jan4.dt.dayofweek + 1) % 7, unit="D")
+    return week1_start + pd.to_timedelta(7 * (epiweek % 100 - 1) + 6, unit="D")
+
+
+class StubEpidata:
+    """
+    Offline stand-in for the Epidata client (the `client` of fetch_epidata and get_from_epidata):
+    serves the rows of `df`, with the columns of the epidata responses (`epiweek`, the values and the
+    location in `location_column`, "region" for fluview, "location" for flusurv), and records each
+    (location, epiweek ranges) request in `requests`.
+    """
+    def __init__(self, df, location_column="region"):
+        self.df = df
+        self.location_column = location_column
+        self.requests = []
+
+    @staticmethod
+    def range(first, last):
+        return {"from": first, "to": last}
+
+    def query(self, location, epiweek_ranges):
+        self.requests.append((location, epiweek_ranges))
+        rows = self.df[self.df[self.location_column] == location]
+        keep = np.zeros(len(rows), dtype=bool)
+        for r in epiweek_ranges:
+            keep |= rows["epiweek"].between(r["from"], r["to"]).to_numpy()
+        if not keep.any():
+            return {"result": -2, "message": "no results", "epidata": []}
+        return {"result": 1, "message": "success", "epidata": rows[keep].to_dict("records")}
+
+    def fluview(self, regions, epiweeks):
+        return self.query(regions, epiweeks)
+
+    def flusurv(self, locations, epiweeks):
+        return self.query(locations, epiweeks)
+
+
+def fetch_epidata_location(dataset, location, client=Epidata, cache_dir="Flusight/flu-datasets/epidata-cache", last_epiweek=202451, refetch_weeks=8):
+    """
+    All the data of one location, from the on-disk cache `cache_dir/dataset/location.csv`, updated
+    with a request for the epiweeks newer than the cached ones and the last `refetch_weeks` cached
+    epiweeks, which may have been backfilled or revised since: the refetched rows replace the cached ones.
+    """
+    cache_fn = os.path.join(cache_dir, dataset, f"{location}.csv")
+    cached = pd.read_csv(cache_fn) if os.path.exists(cache_fn) else None
+    first_epiweek = 190001  # large range to get all data
+    if cached is not None and len(cached):
+        first_epiweek = int((epiweeks.Week.fromstring(str(cached["epiweek"].max()), system="cdc") + (1 - refetch_weeks)).cdcformat())
+    if first_epiweek > last_epiweek:
+        return cached
+
+    res = getattr(client, dataset)(location, [client.range(first_epiweek, last_epiweek)])
+    if res["result"] == 1:
+        new = pd.json_normalize(res["epidata"])
+        print(
+            f">> {location: <12} {res['result']}, {res['message']}, with {len(res['epidata']):4} data points from {new.epiweek.min()} to {new.epiweek.max()}"
+        )
+        df = new if cached is None else pd.concat([cached[cached["epiweek"] < first_epiweek], new], ignore_index=True)
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        df.to_csv(f"{cache_fn}.tmp", index=False)
+        os.replace(f"{cache_fn}.tmp", cache_fn)
+        return df
+    if res["result"] == -2 and cached is not None:  # no results: nothing in the refetched window
+        return cached
+    print(f"EE {location: <12} {res['result']}, {res['message']} !")
+    return cached
+
+
+def fetch_epidata(dataset, locations, client=Epidata, cache_dir="Flusight/flu-datasets/epidata-cache", max_workers=8, last_epiweek=202451, refetch_weeks=8):
+    """
+    Concurrent fetch_epidata_location over `locations` (by location otherwise queries are too big).
+    `client` is anything with the `fluview`/`flusurv` and `range` methods of Epidata, e.g StubEpidata offline.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(executor.map(
+            lambda location: fetch_epidata_location(dataset, location, client=client, cache_dir=cache_dir,
+                                                    last_epiweek=last_epiweek, refetch_weeks=refetch_weeks),
+            locations,
+        ))
+    return pd.concat([df for df in dfs if df is not None], ignore_index=True)
+
+
+# the truth csv in the working copy of the data repository, the same file the vintages are read from
+flusight_truth_files = {dataset: os.path.join(repo_path, path) for dataset, (repo_path, _, path) in vintages.truth_repos.items()}
+
+
+def flusight_truth_data(dataset, vintage_date=None) -> bytes:
+    """ the truth csv of the working copy or, with `vintage_date`, as committed at that date (see vintages) """
+    if vintage_date is not None:
+        return vintages.truth_vintage(dataset, vintage_date)
+    with open(flusight_truth_files[dataset], "rb") as f:
+        return f.read()
+
+
+def cached_flusight_truth(dataset, season_setup: SeasonSetup, value_col=None, clean=True, vintage_date=None, cache_dir="Flusight/flu-datasets/truth-cache"):
+    """
+    get_from_epidata(dataset, season_setup, write=False) of a flusight truth dataset, cached as parquet.
+    The cache key is the sha256 of the truth csv (of the working copy, or of the vintage read from git)
+    and the season setup (start date and locations), so a hit loads the cleaned, merged table directly
+    and each data vintage is parsed once.
+    """
+    data = flusight_truth_data(dataset, vintage_date=vintage_date)
+    h = hashlib.sha256(data)
+    h.update(f"{season_setup.fluseason_startdate}|{','.join(map(str, season_setup.locations))}|{value_col}|{clean}".encode())
+    cache_fn = os.path.join(cache_dir, f"{dataset}-{h.hexdigest()[:20]}.parquet")
+    if os.path.exists(cache_fn):
+        return pd.read_parquet(cache_fn)
+
+    df = get_from_epidata(dataset, season_setup=season_setup, value_col=value_col, write=False, clean=clean, use_cache=False, source=io.BytesIO(data))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"  # several jobs may fill the same entry
+        df.to_parquet(tmp_fn, index=False)
+        os.replace(tmp_fn, cache_fn)
+    except ImportError as e:  # no parquet engine, just don't cache
+        print(f" ⚠️ not caching {dataset}: {e}")
+    return df
+
+
 def get_from_epidata(
     dataset,
     season_setup: SeasonSetup = None,
@@ -102,7 +237,11 @@ def get_from_epidata(
     value_col=None,
     write=True,
     download=True,
-    clean = True
+    clean = True,
+    client=Epidata,
+    use_cache=True,
+    vintage_date=None,
+    source=None,
 ):
     """ 
     Read a dataset from epidata. Each dataset is a dataframe with columns:
@@ -111,55 +250,35 @@ def get_from_epidata(
     - 'value' (float) the value of interest
     - 'fluseason' (int) the flu season (e.g. 2019)
     - 'fluseason_fraction' (float) the fraction of the flu season (e.g. 0.5 for the middle of the season)
+    With download, the epidata responses are cached per location and only newer epiweeks are requested
+    (see fetch_epidata). `client` replaces the Epidata client, e.g with a stub to run offline.
+    The parsed flusight truth tables are cached (see cached_flusight_truth) unless `use_cache=False`.
+    With `vintage_date`, the flusight truth is read as it was committed at that date in its data
+    repository, without checking it out. `source` replaces the flusight truth csv file (path or buffer).
     """
+    if use_cache and dataset in flusight_truth_files and season_setup is not None and not write:
+        return cached_flusight_truth(dataset, season_setup=season_setup, value_col=value_col, clean=clean, vintage_date=vintage_date)
+    if source is None and dataset in flusight_truth_files:
+        source = io.BytesIO(flusight_truth_data(dataset, vintage_date=vintage_date)) if vintage_date is not None else flusight_truth_files[dataset]
 
     if dataset == "flusurv" or dataset == "fluview":
         if download:
-            # by location otherwise queries is too big
-            df_list = []
             if locations == "all":
                 locations = get_dataset_all_locations(dataset=dataset)
-
-            for location in locations:
-                if dataset == "flusurv":
-                    res = Epidata.flusurv(
-                        location, [Epidata.range(190001, 202451)]
-                    )  # large range to get all data
-                elif dataset == "fluview":
-                    res = Epidata.fluview(
-                        location, [Epidata.range(190001, 202451)]
-                    )  # large range to get all data
-                if res["result"] == 1:
-                    flu_data_loc = pd.json_normalize(res["epidata"])
-                    print(
-                        f">> {location: <12} {res['result']}, {res['message']}, with {len(res['epidata']):4} data points from {flu_data_loc.epiweek.min()} to {flu_data_loc.epiweek.max()}"
-                    )
-                    df_list.append(flu_data_loc)
-                else:
-                    print(f"EE {location: <12} {res['result']}, {res['message']} !")
-
-            df = pd.concat(df_list)
-            df["week_enddate"] = (
-                df["epiweek"]
-                .astype(str)
-                .apply(
-                    lambda x: epiweeks.Week.fromstring(
-                        week_string=x, system="cdc"
-                    ).enddate()
-                )
-            )
+            df = fetch_epidata(dataset=dataset, locations=locations, client=client)
+            df["week_enddate"] = epiweek_to_enddate(df["epiweek"])
         else:
             df = pd.read_csv(f"Flusight/flu-datasets/{dataset}.csv")
     elif dataset == "flusight2022_23":
         df = pd.read_csv(
-            "Flusight/2022-2023/FluSight-forecast-hub-official/data-truth/truth-Incident Hospitalizations.csv",
+            source,
             parse_dates=True,
             index_col="date",
         )
         df["week_enddate"] = df.index
     elif dataset == "flusight2023_24":
         df = pd.read_csv(
-            "Flusight/2023-2024/FluSight-forecast-hub-official/auxiliary-data/target-data-archive/target-hospital-admissions_2024-04-27.csv",
+            source,
             parse_dates=True,
             index_col="date",
         )
@@ -231,8 +350,7 @@ def get_from_epidata(
     df["value"] = df[value_col]
 
     # get the flu season year and it's fraction elapsed
-    df["fluseason"] = df["week_enddate"].apply(season_setup.get_fluseason_year)
-    df["fluseason_fraction"] = df["week_enddate"].apply(season_setup.get_fluseason_fraction)
+    df["fluseason"], df["fluseason_fraction"] = season_setup.get_fluseason_year_fraction(df["week_enddate"])
     print(f"RAW Dataset {dataset} has {len(df)} data points, with {len(df['location_code'].unique())} locations,"
             f"and NA values: {df['value'].isna().sum()}, NA locations: {df['location_code'].isna().sum()}")
     # select only the columns we need
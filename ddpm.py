@@ -1,9 +1,9 @@
 import math
+import copy
+import contextlib
 from inspect import isfunction
 from functools import partial
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
 from tqdm.auto import tqdm
 from einops import rearrange
 
@@ -15,18 +15,26 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-import data_utils, training_datasets
+import training_datasets
 from torch.utils.data import DataLoader
 from torchvision import transforms
-from torchvision.utils import save_image
 from torch.optim import Adam
 import datetime
+import time
 
 import myutils
+import distributed
+from monitor import TrainingMonitor
 
 
 class DDPM:
-    def __init__(self, model, image_size=64, channels=1, batch_size=512, epochs=500,  timesteps=200, loss_type="huber", device=None) -> None:
+    def __init__(self, model, image_size=64, channels=1, batch_size=512, epochs=500,  timesteps=200, loss_type="huber", device=None, precision="fp32", channels_last=False, ema_decay=None) -> None:
+        """
+        precision: "fp32", "bf16" or "fp16" (autocast of the Unet forward passes, with loss scaling for fp16)
+        channels_last: use the channels_last memory format for the Unet and its inputs
+        ema_decay: if given (e.g 0.999), keep an exponential moving average of the weights during training,
+            used for sampling (see use_ema and select_weights)
+        """
         self.model = model
         self.image_size = image_size
         self.channels = channels
@@ -37,6 +45,22 @@ class DDPM:
         self.timesteps = timesteps
         self.loss_type=loss_type
 
+        if precision not in autocast_dtypes:
+            raise ValueError(f"precision {precision} not supported, use one of {list(autocast_dtypes)}")
+        self.precision = precision
+        # precision of a loaded checkpoint that does not record one, see load_model_checkpoint
+        self.default_precision = precision
+        self.channels_last = channels_last
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        # compiled/traced version of the sampling model used by model_fn, see compile_inference
+        self.inference_model = None
+        self.inference_is_ema = False
+
+        # shadow copy of the weights, averaged every optimizer step. Sampling uses it when use_ema is set
+        self.ema_decay = ema_decay
+        self.ema_model = self.new_ema_model() if ema_decay else None
+        self.use_ema = True
+
         self.device = device
         if self.device is None:
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -61,14 +85,167 @@ class DDPM:
             self.betas * (1.0 - self.alphas_cumprod_prev) / (1.0 - self.alphas_cumprod)
         )
 
+        # during sampling all t in the batch are equal: keep the coefficients of each step as python
+        # floats so the reverse steps need no gather nor device synchronization.
+        self.step_coefficients = [
+            {name: getattr(self, name)[i].item() for name in schedule_buffers}
+            for i in range(self.timesteps)
+        ]
+        self.to(self.device)
+
         self.results_folder = Path("./results")
         self.results_folder.mkdir(exist_ok=True)
-        self.save_and_sample_every = 1000
+        self.preview_every_epochs = 50
 
 
 
         
         self.optimizer = Adam(self.model.parameters(), lr=1e-3)
+        self.scheduler = torch.optim.lr_scheduler.ExponentialLR(self.optimizer, gamma=0.99)
+        # loss scaling is only needed for fp16, bf16 has the range of fp32
+        self.scaler = self.new_scaler()
+
+        # training progress, saved in checkpoints so that training can resume mid-run
+        self.epoch = 0  # number of completed epochs
+        self.step = 0  # number of optimizer steps
+        self.losses = []
+
+    def to(self, device):
+        """ Move the model and the schedule tensors (used with myutils.extract on batches of t) to `device` """
+        self.device = device
+        self.model.to(device, memory_format=self.memory_format)
+        if self.ema_model is not None:
+            self.ema_model.to(device, memory_format=self.memory_format)
+        for name in schedule_buffers:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def unwrapped_model(self):
+        """ the Unet, without the DistributedDataParallel wrapper used during distributed training """
+        return getattr(self.model, "module", self.model)
+
+    def new_scaler(self):
+        return torch.cuda.amp.GradScaler(enabled=(self.precision == "fp16" and "cuda" in str(self.device)))
+
+    def new_ema_model(self):
+        return copy.deepcopy(self.unwrapped_model()).eval().requires_grad_(False)
+
+    @torch.no_grad()
+    def update_ema(self):
+        """ in-place update of the EMA weights on device, with a warmup of the decay over the first steps """
+        decay = min(self.ema_decay, (1 + self.step) / (10 + self.step))
+        model = self.unwrapped_model()
+        ema_params = list(self.ema_model.parameters())
+        torch._foreach_mul_(ema_params, decay)
+        torch._foreach_add_(ema_params, list(model.parameters()), alpha=1 - decay)
+        for ema_buffer, buffer in zip(self.ema_model.buffers(), model.buffers()):
+            ema_buffer.copy_(buffer)
+
+    def ema_selected(self):
+        return self.use_ema and self.ema_model is not None
+
+    def sampling_model(self):
+        """ the network used by model_fn: the EMA weights if there are and use_ema is set, else the raw weights """
+        return self.ema_model if self.ema_selected() else self.model
+
+    @contextlib.contextmanager
+    def select_weights(self, use_ema=None):
+        """ context to sample (sample, REpaint, CoPaint with model_fn) with (True) or without (False) the EMA weights """
+        previous = self.use_ema
+        if use_ema is not None:
+            self.use_ema = use_ema
+        try:
+            yield self
+        finally:
+            self.use_ema = previous
+
+    def autocast(self):
+        """ autocast context for the forward passes of the model, a no-op in fp32 """
+        device_type = "cuda" if "cuda" in str(self.device) else "cpu"
+        return torch.autocast(
+            device_type=device_type,
+            dtype=autocast_dtypes[self.precision],
+            enabled=self.precision != "fp32",
+        )
+
+    def model_fn(self, x, t, **kwargs):
+        """
+        Evaluate the noise predictor with the configured precision and memory format. The output is
+        always float32 so the sampling arithmetic is unaffected. This is also the model_fn to give
+        to the CoPaint sampler.
+        """
+        with self.autocast():
+            if self.inference_model is not None and self.inference_is_ema == self.ema_selected():
+                # the compiled Unet ignores the extra kwargs anyway, traced modules do not accept them
+                predicted_noise = self.inference_model(x.contiguous(memory_format=self.memory_format), t)
+            else:
+                predicted_noise = self.sampling_model()(x.contiguous(memory_format=self.memory_format), t, **kwargs)
+        return predicted_noise.float()
+
+    def inference_cache_key(self, batch_size):
+        """ hash of what a traced module depends on: Unet architecture, weights, input shape, precision and device """
+        import hashlib
+        h = hashlib.sha256()
+        model = self.sampling_model()
+        h.update(repr(model).encode())
+        h.update(f"{batch_size}-{self.channels}-{self.image_size}-{self.precision}-{self.channels_last}-{torch.device(self.device).type}-{torch.__version__}".encode())
+        for name, tensor in model.state_dict().items():
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+        return h.hexdigest()[:16]
+
+    def compile_inference(self, mode="compile", batch_size=None, cache_dir="compiled_models"):
+        """
+        Opt-in compiled inference path, used transparently by model_fn (thus sample, REpaint and CoPaint).
+        - mode="compile": torch.compile (PyTorch >= 2)
+        - mode="trace": torch.jit.trace, cached to `cache_dir` keyed on inference_cache_key so each
+          checkpoint is traced once per shape/precision/device.
+        If compiling fails (e.g no C compiler on a CPU-only node, or old PyTorch), it falls back to
+        tracing, then to the eager model, so sampling always works. Must be called again after the
+        weights change (train and load_model_checkpoint reset it). The weights selected by use_ema
+        are compiled, the other ones run eagerly.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        self.inference_model = None
+        self.inference_is_ema = self.ema_selected()
+        model = self.sampling_model()
+        example_x = torch.randn((batch_size, self.channels, self.image_size, self.image_size), device=self.device)
+        example_x = example_x.contiguous(memory_format=self.memory_format)
+        example_t = torch.full((batch_size,), self.timesteps - 1, device=self.device, dtype=torch.long)
+
+        if mode == "compile":
+            try:
+                compiled = torch.compile(model)
+                with torch.no_grad(), self.autocast():
+                    compiled(example_x, example_t)  # compile now, so failures happen here
+                self.inference_model = compiled
+                print(f" -- using torch.compile'd Unet for inference on {self.device}")
+                return self.inference_model
+            except Exception as e:
+                print(f" !! torch.compile failed ({type(e).__name__}: {e}), falling back to tracing")
+                mode = "trace"
+
+        if mode == "trace":
+            try:
+                Path(cache_dir).mkdir(parents=True, exist_ok=True)
+                cache_fn = Path(cache_dir) / f"unet-{self.inference_cache_key(batch_size)}.pt"
+                if cache_fn.exists():
+                    traced = torch.jit.load(str(cache_fn), map_location=self.device)
+                    print(f" -- loaded traced Unet from {cache_fn}")
+                else:
+                    with torch.no_grad(), self.autocast():
+                        traced = torch.jit.trace(model, (example_x, example_t))
+                    torch.jit.save(traced, str(cache_fn))
+                    print(f" -- traced Unet saved to {cache_fn}")
+                self.inference_model = traced
+                return self.inference_model
+            except Exception as e:
+                print(f" !! tracing failed ({type(e).__name__}: {e}), using the eager Unet")
+        elif mode not in ("none", None):
+            raise ValueError(f"compile mode {mode} not supported, use 'compile', 'trace' or 'none'")
+
+        return self.inference_model
 
     def q_sample(self, x_start, t, noise=None):
         """ Forward diffusion """
@@ -86,35 +263,90 @@ class DDPM:
 
     @torch.no_grad()
     def p_sample(self, x, t, t_index):
-        betas_t = myutils.extract(self.betas, t, x.shape)
-        sqrt_one_minus_alphas_cumprod_t = myutils.extract(
-            self.sqrt_one_minus_alphas_cumprod, t, x.shape
-        )
-        sqrt_recip_alphas_t = myutils.extract(self.sqrt_recip_alphas, t, x.shape)
+        coefs = self.step_coefficients[t_index]
+        betas_t = coefs["betas"]
+        sqrt_one_minus_alphas_cumprod_t = coefs["sqrt_one_minus_alphas_cumprod"]
+        sqrt_recip_alphas_t = coefs["sqrt_recip_alphas"]
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
         model_mean = sqrt_recip_alphas_t * (
-            x - betas_t * self.model(x, t) / sqrt_one_minus_alphas_cumprod_t
+            x - betas_t * self.model_fn(x, t) / sqrt_one_minus_alphas_cumprod_t
         )
 
         if t_index == 0:
             return model_mean
         else:
-            posterior_variance_t = myutils.extract(self.posterior_variance, t, x.shape)
+            posterior_variance_t = coefs["posterior_variance"]
             noise = torch.randn_like(x)
             # Algorithm 2 line 4:
-            return model_mean + torch.sqrt(posterior_variance_t) * noise
+            return model_mean + math.sqrt(posterior_variance_t) * noise
+
+    def respaced_schedule(self, use_timesteps):
+        """
+        Recompute the diffusion schedule for a subsequence of the training timesteps (as in
+        Nichol & Dhariwal 2021, section 4): the new betas are chosen so that the cumulative
+        products of alphas match the ones of the full chain at the retained timesteps.
+        """
+        use_timesteps = torch.as_tensor(sorted(use_timesteps), dtype=torch.long, device=self.alphas_cumprod.device)
+        alphas_cumprod = self.alphas_cumprod[use_timesteps]
+        alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
+        betas = 1.0 - alphas_cumprod / alphas_cumprod_prev
+        return {
+            "timesteps": use_timesteps,
+            "betas": betas,
+            "alphas_cumprod": alphas_cumprod,
+            "alphas_cumprod_prev": alphas_cumprod_prev,
+        }
+
+    @torch.no_grad()
+    def ddim_sample(self, x, t, t_index, schedule, eta=1.0):
+        """
+        One reverse step on a respaced schedule. `t` holds the timesteps of the full chain (what the
+        model was trained on), `t_index` the position in the respaced schedule. eta=0 gives the
+        deterministic DDIM sampler, eta=1 the ancestral DDPM sampler on the respaced chain.
+        """
+        alphas_cumprod_t = schedule["alphas_cumprod"][t_index]
+        alphas_cumprod_prev_t = schedule["alphas_cumprod_prev"][t_index]
+
+        predicted_noise = self.model_fn(x, t)
+        x_start = (x - math.sqrt(1.0 - alphas_cumprod_t) * predicted_noise) / math.sqrt(alphas_cumprod_t)
+
+        if t_index == 0:
+            return x_start
+
+        sigma_t = (
+            eta
+            * math.sqrt((1.0 - alphas_cumprod_prev_t) / (1.0 - alphas_cumprod_t))
+            * math.sqrt(1.0 - alphas_cumprod_t / alphas_cumprod_prev_t)
+        )
+        dir_xt = math.sqrt(1.0 - alphas_cumprod_prev_t - sigma_t ** 2) * predicted_noise
+        noise = torch.randn_like(x)
+        return math.sqrt(alphas_cumprod_prev_t) * x_start + dir_xt + sigma_t * noise
 
     # Algorithm 2 but save all images:
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_loop(self, shape, sampling_steps=None, eta=1.0, keep_every=None, callback=None):
+        """
+        Run the reverse process. If `sampling_steps` is given (e.g 25 or 50), only this many evenly
+        spaced timesteps of the training chain are walked through using `ddim_sample` with
+        parameter `eta`, otherwise every one of `self.timesteps` steps is run.
+        `eta` defaults to 1.0 in every sampling entry point (sample, p_sample_loop, ddim_sample_loop):
+        respaced ancestral sampling, the same kind of sampler as the full chain, only with fewer steps.
+        Pass eta=0.0 for deterministic DDIM.
+
+        Returns a list of the retained images: only the final sample by default, see
+        `myutils.Trajectory` for `keep_every` and `callback`.
+        """
+        if sampling_steps is not None and sampling_steps < self.timesteps:
+            return self.ddim_sample_loop(shape, sampling_steps=sampling_steps, eta=eta, keep_every=keep_every, callback=callback)
+
         device = next(self.model.parameters()).device
 
         b = shape[0]
         # start from pure noise (for each example in the batch)
         img = torch.randn(shape, device=device)
-        imgs = []
+        trajectory = myutils.Trajectory(keep_every=keep_every, callback=callback)
 
         for i in tqdm(
             reversed(range(0, self.timesteps)),
@@ -124,114 +356,260 @@ class DDPM:
             img = self.p_sample(
                 img, torch.full((b,), i, device=device, dtype=torch.long), i
             )
-            imgs.append(img.cpu().numpy())
-        return imgs
+            trajectory.record(i, img, last=(i == 0))
+        return trajectory.imgs
 
     @torch.no_grad()
-    def sample(self):
-        return self.p_sample_loop(
-            shape=(self.batch_size, self.channels, self.image_size, self.image_size),
-        )
+    def ddim_sample_loop(self, shape, sampling_steps=50, eta=1.0, keep_every=None, callback=None):
+        device = next(self.model.parameters()).device
+        # python floats, so that the steps need no device synchronization
+        schedule = self.respaced_schedule(space_timesteps(self.timesteps, sampling_steps))
+        schedule = {k: v.tolist() for k, v in schedule.items()}
 
-    def train(self, dataloader):
-        print(f"/!\ training on {self.device}")
-        if torch.cuda.device_count() > 1:
-            print(" -- using dataparallel")
-            self.model = nn.DataParallel(self.model)
+        b = shape[0]
+        img = torch.randn(shape, device=device)
+        trajectory = myutils.Trajectory(keep_every=keep_every, callback=callback)
 
-        self.model.to(self.device)
+        for i in tqdm(
+            reversed(range(0, len(schedule["timesteps"]))),
+            desc="respaced sampling loop time step",
+            total=len(schedule["timesteps"]),
+        ):
+            t = torch.full((b,), int(schedule["timesteps"][i]), device=device, dtype=torch.long)
+            img = self.ddim_sample(img, t, i, schedule=schedule, eta=eta)
+            trajectory.record(i, img, last=(i == 0))
+        return trajectory.imgs
 
-        if self.device == "cuda":
-            print(myutils.cuda_mem_info())
+    @torch.no_grad()
+    def sample(self, sampling_steps=None, eta=1.0, keep_every=None, callback=None, use_ema=None):
+        """ use_ema: sample with the EMA (True) or the raw (False) weights, default: self.use_ema """
+        with self.select_weights(use_ema):
+            return self.p_sample_loop(
+                shape=(self.batch_size, self.channels, self.image_size, self.image_size),
+                sampling_steps=sampling_steps,
+                eta=eta,
+                keep_every=keep_every,
+                callback=callback,
+            )
 
-        scheduler1 = torch.optim.lr_scheduler.ExponentialLR(self.optimizer, gamma=0.99)
+    def train(self, dataloader, checkpoint_path=None, checkpoint_every_epochs=None, checkpoint_every_minutes=None, monitor=None):
+        """
+        Train from epoch `self.epoch` (0, or where a checkpoint loaded by load_model_checkpoint stopped)
+        to `self.epochs`. If `checkpoint_path` is given, the full training state is written there every
+        `checkpoint_every_epochs` epochs and/or `checkpoint_every_minutes` minutes, atomically and in a
+        background thread so the training loop does not wait for the disk.
+
+        Loss curves, throughput and sample previews are written by `monitor` (a monitor.TrainingMonitor,
+        by default one writing to `self.results_folder`) in a background thread.
+
+        With `ema_decay`, the EMA weights are updated after every optimizer step.
+
+        When the process group is initialized (see distributed.init_from_env and distributed.spawn), the
+        model is wrapped in DistributedDataParallel, each process training on its shard of the data
+        (see distributed.distributed_dataloader). Only rank 0 monitors and writes checkpoints, and the
+        model is unwrapped at the end so that state dicts never have `module.` prefixes.
+
+        See train_group to train several DDPMs on the same data in one process.
+        """
+        session = self.start_training(checkpoint_path=checkpoint_path, checkpoint_every_epochs=checkpoint_every_epochs,
+                                      checkpoint_every_minutes=checkpoint_every_minutes, monitor=monitor)
+        for epoch in range(self.epoch, self.epochs):
+            set_loader_epoch(dataloader, epoch)
+            for step, batch in enumerate(dataloader):
+                self.train_step(batch, session, log=(step % 100 == 0))
+            self.end_epoch(session)
+        self.finish_training(session)
 
-        losses = []
+    def start_training(self, checkpoint_path=None, checkpoint_every_epochs=None, checkpoint_every_minutes=None, monitor=None):
+        """ prepare the model, monitor and checkpoint writer of a training, returns the session given to train_step, end_epoch and finish_training """
+        print(f"/!\ training on {self.device}")
+        self.inference_model = None  # weights will change
+        world_size = distributed.get_world_size()
+        is_main = distributed.is_main_process()
+
+        if self.ema_decay and self.ema_model is None:
+            self.ema_model = self.new_ema_model()
+        self.to(self.device)
+        if world_size > 1:
+            print(f" -- using DistributedDataParallel, rank {distributed.get_rank()}/{world_size}")
+            device_ids = [torch.device(self.device).index] if "cuda" in str(self.device) else None
+            self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=device_ids)
+            # all ranks restored the same RNG state from a checkpoint: give each one its own stream
+            seed = int(torch.randint(2**31 - 1, (1,)).item()) + distributed.get_rank()
+            torch.manual_seed(seed)
+            np.random.seed(seed)
 
-        for epoch in range(self.epochs):
-            for step, batch in enumerate(dataloader):
-                self.optimizer.zero_grad()
-
-                # self.batch_size = batch["pixel_values"].shape[0]
-                # batch = batch["pixel_values"].to(self.device)
-                self.batch_size = batch.shape[0]
-                batch = batch.to(self.device)
-
-                # Algorithm 1 line 3: sample t uniformally for every example in the batch
-                # Important to have a number of epoch sufficiently large to see all the self.timesteps
-                t = torch.randint(
-                    0, self.timesteps, (self.batch_size,), device=self.device
-                ).long()
-
-                loss = self.p_losses(
-                    denoise_model=self.model, x_start=batch, t=t, loss_type=self.loss_type
-                )  # loss_type="l2")#
-
-                if step % 100 == 0:
-                    print(f"Epoch: {epoch:<4} -- Loss: {loss.item()}")
-                # if self.device == "cuda":
-                #    print(f"   -- {helpers.cuda_mem_info()}")
-                loss.backward()
-                self.optimizer.step()
-                losses.append(loss.item())
-
-                if epoch % 50 == 0 and epoch > 0 and step == 0:
-                    fig, axes = plt.subplots(1, 3, figsize=(6, 2), dpi=100)
-                    axes.flat[0].plot(np.arange(len(losses)), np.array(losses))
-                    axes.flat[1].plot(
-                        np.arange(len(losses[-100:])), np.array(losses[-100:])
-                    )
-                    axes.flat[2].plot(
-                        np.arange(len(losses[-50:])), np.array(losses[-50:])
-                    )
-                    plt.show()
-
-                # save generated images
-                if step != 0 and step % self.save_and_sample_every == 0:
-                    milestone = step // self.save_and_sample_every
-                    batches = myutils.num_to_groups(4, self.batch_size)
-                    all_images_list = list(
-                        map(
-                            lambda n: self.sample(
-                                self.model, batch_size=n, channels=self.channels
-                            ),
-                            batches,
-                        )
-                    )
-                    all_images = torch.cat(all_images_list, dim=0)
-                    all_images = (all_images + 1) * 0.5
-                    save_image(
-                        all_images,
-                        str(self.results_folder / f"sample-{milestone}.png"),
-                        nrow=6,
-                    )
-
-            # scheduler1.step()
+        if self.device == "cuda":
+            print(myutils.cuda_mem_info())
+
+        if not is_main:
+            monitor = None
+        elif monitor is None:
+            monitor = TrainingMonitor(self.results_folder, preview_every_epochs=self.preview_every_epochs)
+        if monitor is not None:
+            monitor.start()
+        if self.epoch >= self.epochs:
+            # e.g a model reused after a finished training: each trained spec needs a fresh DDPM (LazyLibrary.build)
+            print(f" !! this model is already trained ({self.epoch}/{self.epochs} epochs), nothing to train")
+        elif self.epoch > 0:
+            print(f" -- resuming training at epoch {self.epoch}/{self.epochs}")
+        return {
+            "world_size": world_size,
+            "is_main": is_main,
+            "monitor": monitor,
+            "checkpoint_writer": myutils.AsyncCheckpointWriter() if checkpoint_path is not None and is_main else None,
+            "checkpoint_path": checkpoint_path,
+            "checkpoint_every_epochs": checkpoint_every_epochs,
+            "checkpoint_every_minutes": checkpoint_every_minutes,
+            "last_checkpoint_time": time.monotonic(),
+        }
+
+    def train_step(self, batch, session, log=False):
+        """ one optimizer step on `batch` (already transformed) """
+        self.optimizer.zero_grad()
+
+        # self.batch_size = batch["pixel_values"].shape[0]
+        # batch = batch["pixel_values"].to(self.device)
+        self.batch_size = batch.shape[0]
+        batch = batch.to(self.device, memory_format=self.memory_format)
+
+        # Algorithm 1 line 3: sample t uniformally for every example in the batch
+        # Important to have a number of epoch sufficiently large to see all the self.timesteps
+        t = torch.randint(
+            0, self.timesteps, (self.batch_size,), device=self.device
+        ).long()
+
+        with self.autocast():
+            loss = self.p_losses(
+                denoise_model=self.model, x_start=batch, t=t, loss_type=self.loss_type
+            )  # loss_type="l2")#
+
+        if log and session["is_main"]:
+            print(f"Epoch: {self.epoch:<4} -- Loss: {loss.item()}")
+        # if self.device == "cuda":
+        #    print(f"   -- {helpers.cuda_mem_info()}")
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
+        scale = self.scaler.get_scale()
+        self.scaler.update()
+        self.step += 1
+        # with fp16 the scaler skips the optimizer step on inf/nan gradients (and lowers its scale):
+        # the weights did not move, so neither does their average
+        if self.ema_model is not None and self.scaler.get_scale() >= scale:
+            self.update_ema()
+        self.losses.append(loss.item())
+
+        if session["monitor"] is not None:
+            session["monitor"].log_step(self.epoch, self.step, self.losses[-1], self.batch_size * session["world_size"])
+        return self.losses[-1]
+
+    def end_epoch(self, session):
+        # self.scheduler.step()
+        self.epoch = self.epoch + 1
+        if session["monitor"] is not None:
+            session["monitor"].log_epoch(self, self.epoch)
+
+        if session["checkpoint_writer"] is not None:
+            due_epochs = session["checkpoint_every_epochs"] is not None and self.epoch % session["checkpoint_every_epochs"] == 0
+            due_minutes = session["checkpoint_every_minutes"] is not None and time.monotonic() - session["last_checkpoint_time"] > 60 * session["checkpoint_every_minutes"]
+            if due_epochs or due_minutes:
+                session["checkpoint_writer"].submit(self.training_state(), session["checkpoint_path"])
+                session["last_checkpoint_time"] = time.monotonic()
+
+    def finish_training(self, session):
+        if session["checkpoint_writer"] is not None:
+            session["checkpoint_writer"].submit(self.training_state(), session["checkpoint_path"])
+            session["checkpoint_writer"].wait()
+        if session["monitor"] is not None:
+            session["monitor"].close()
+        self.model = self.unwrapped_model()
+        distributed.barrier()  # the checkpoint is written when any rank returns
+
+    def preview_copy(self):
+        """
+        Shallow copy of this DDPM with a CPU, fp32 copy of the model, for sampling previews
+        off the training device (see monitor.TrainingMonitor).
+        """
+        preview = copy.copy(self)
+        preview.model = copy.deepcopy(self.ema_model if self.ema_selected() else self.unwrapped_model()).to("cpu").eval()
+        preview.ema_model = None
+        preview.device = "cpu"
+        preview.precision = "fp32"
+        preview.memory_format = torch.contiguous_format
+        preview.inference_model = None
+        for name in schedule_buffers:
+            setattr(preview, name, getattr(self, name).cpu())
+        return preview
+
+    def training_state(self):
+        """ Full training state, copied to CPU so it can be written while training continues """
+        return myutils.state_to_cpu({
+            "epochs": self.epochs,
+            "epoch": self.epoch,
+            "step": self.step,
+            "model_state_dict": self.unwrapped_model().state_dict(),
+            "optimizer_state_dict": self.optimizer.state_dict(),
+            "scheduler_state_dict": self.scheduler.state_dict(),
+            "scaler_state_dict": self.scaler.state_dict(),
+            "rng_state": myutils.get_rng_state(),
+            "losses": list(self.losses),
+            "loss_type": self.loss_type,
+            "timesteps": self.timesteps,
+            "precision": self.precision,
+            "ema_decay": self.ema_decay,
+            "ema_state_dict": self.ema_model.state_dict() if self.ema_model is not None else None,
+        })
 
     def write_train_checkpoint(self, save_path=None):
         if save_path is None:
             save_path = f"checkpoint-{self.epoch}.pth"
-        torch.save(
-            {
-                "epochs": self.epochs,
-                "model_state_dict": self.model.state_dict(),
-                "optimizer_state_dict": self.optimizer.state_dict(),
-                "loss_type": self.loss_type,
-            },
-            save_path,
-        )
+        myutils.atomic_torch_save(self.training_state(), save_path)
         return save_path
 
-    def load_model_checkpoint(self, checkpoint_path):
+    def load_model_checkpoint(self, checkpoint_path, use_checkpoint_precision=False):
+        """
+        Load a checkpoint written by write_train_checkpoint or during train. Checkpoints with the full
+        training state restore the progress (epoch, step, scheduler, RNG, losses, EMA weights), so
+        that calling train again resumes where it stopped. With `use_checkpoint_precision`, the
+        precision the checkpoint was trained with (if recorded) replaces the precision given to the
+        constructor. Nothing is kept from a previously loaded checkpoint, so a DDPM can be reused.
+        """
         checkpoint = torch.load(checkpoint_path, map_location=torch.device("cpu"))
-        self.model.load_state_dict(checkpoint["model_state_dict"])
+        precision = checkpoint.get("precision", self.default_precision) if use_checkpoint_precision else self.default_precision
+        if precision != self.default_precision:
+            print(f" -- using the precision of the checkpoint: {precision}")
+        self.precision = precision
+        self.scaler = self.new_scaler()
+        self.inference_model = None
+        self.inference_is_ema = False
+        # checkpoints of the former nn.DataParallel training have `module.` prefixed keys
+        self.unwrapped_model().load_state_dict(myutils.unwrap_state_dict(checkpoint["model_state_dict"]))
         self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
         self.epochs = checkpoint["epochs"]
         self.loss_type = checkpoint["loss_type"]
+        # older checkpoints were only written at the end of the training
+        self.epoch = checkpoint.get("epoch", self.epochs)
+        self.step = checkpoint.get("step", 0)
+        self.losses = checkpoint.get("losses", [])
+        if "scheduler_state_dict" in checkpoint:
+            self.scheduler.load_state_dict(checkpoint["scheduler_state_dict"])
+        if "scaler_state_dict" in checkpoint:
+            self.scaler.load_state_dict(checkpoint["scaler_state_dict"])
+        if "rng_state" in checkpoint:
+            myutils.set_rng_state(checkpoint["rng_state"])
+        if checkpoint.get("ema_state_dict") is not None:
+            if self.ema_model is None:
+                self.ema_model = self.new_ema_model()
+            self.ema_model.load_state_dict(checkpoint["ema_state_dict"])
+            self.ema_decay = checkpoint["ema_decay"]
+        else:
+            # never keep the EMA weights of a previously loaded checkpoint
+            self.ema_model = None
+            self.ema_decay = None
         self.model.eval()
         # necessary ????
         self.model.train()
-        self.model.to(self.device)
+        self.to(self.device)
 
     def p_losses(self, denoise_model, x_start, t, noise=None, loss_type="l1"):
         if noise is None:
@@ -254,6 +632,75 @@ class DDPM:
         return loss
 
 
+# dtypes used by DDPM.autocast for each precision
+autocast_dtypes = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+# schedule tensors of DDPM, moved with the model by DDPM.to()
+schedule_buffers = (
+    "betas",
+    "alphas",
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "sqrt_recip_alphas",
+    "sqrt_alphas_cumprod",
+    "sqrt_one_minus_alphas_cumprod",
+    "posterior_variance",
+)
+
+
+def space_timesteps(num_timesteps, sampling_steps):
+    """
+    Evenly spaced subsequence of `sampling_steps` timesteps out of `range(num_timesteps)`, always
+    containing the first and the last one.
+    """
+    if sampling_steps > num_timesteps:
+        raise ValueError(f"cannot sample with {sampling_steps} steps a model trained with {num_timesteps} timesteps")
+    return sorted(set(np.linspace(0, num_timesteps - 1, sampling_steps).round().astype(int).tolist()))
+
+
+def set_loader_epoch(dataloader, epoch):
+    """ reshuffle the shards of a DistributedSampler or a distributed BatchedFluLoader """
+    for loader in (dataloader, getattr(dataloader, "sampler", None)):
+        if hasattr(loader, "set_epoch"):
+            loader.set_epoch(epoch)
+
+
+def train_group(members, dataloader):
+    """
+    Train several DDPMs in one process on the same data, e.g specs that only differ by their transform
+    and enrichment: each raw batch of `dataloader` (e.g a BatchedFluLoader without transforms) is read
+    once and fanned out to every member, which applies its own batched `transform` and steps its model.
+    The steps of the models are interleaved, so the data loading is amortized over the group and a
+    large GPU holds all the models.
+
+    `members` is a list of dicts with keys "ddpm", "transform" (batch -> batch, applied to the raw batch)
+    and optionally "checkpoint_path", "checkpoint_every_epochs", "checkpoint_every_minutes" and "monitor"
+    as for DDPM.train. Members resumed from checkpoints at different epochs each train up to their own
+    `epochs`.
+    """
+    sessions = [
+        member["ddpm"].start_training(checkpoint_path=member.get("checkpoint_path"),
+                                      checkpoint_every_epochs=member.get("checkpoint_every_epochs"),
+                                      checkpoint_every_minutes=member.get("checkpoint_every_minutes"),
+                                      monitor=member.get("monitor"))
+        for member in members
+    ]
+    for epoch in range(min(m["ddpm"].epoch for m in members), max(m["ddpm"].epochs for m in members)):
+        active = [(m, session) for m, session in zip(members, sessions) if m["ddpm"].epoch == epoch < m["ddpm"].epochs]
+        set_loader_epoch(dataloader, epoch)
+        for step, raw_batch in enumerate(dataloader):
+            for member, session in active:
+                member["ddpm"].train_step(member["transform"](raw_batch), session, log=(step % 100 == 0))
+        for member, session in active:
+            member["ddpm"].end_epoch(session)
+    for member, session in zip(members, sessions):
+        member["ddpm"].finish_training(session)
+
+
 # ## Defining the forward diffusion process
 # The forward diffusion process gradually adds noise to an image from the real distribution, in a number of time steps $T$. This happens according to a **variance schedule**. The original DDPM authors employed a linear schedule:
 #
@@ -0,0 +1,88 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+import training_datasets
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_from_env(backend=None):
+    """
+    Initialize the process group from the environment set by torchrun (WORLD_SIZE, RANK, LOCAL_RANK,
+    MASTER_ADDR, MASTER_PORT), e.g `torchrun --nproc_per_node=4 main.py -t True ...`.
+    Returns the device of this process, or None when not launched with several processes.
+    The backend defaults to nccl with GPUs and gloo on CPU.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return None
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
+    if backend == "nccl":
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        device = "cpu"
+    print(f" -- process {get_rank()}/{get_world_size()} on {device} ({backend})")
+    return device
+
+
+def spawned_worker(rank, fn, world_size, backend, port, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn(fn, world_size, backend="gloo", port=29512, args=()):
+    """
+    Run `fn(rank, world_size, *args)` in `world_size` local processes sharing a process group, without
+    torchrun: with gloo this runs the distributed training path on a CPU-only machine. `fn` must be
+    importable (defined at module level).
+    """
+    torch.multiprocessing.spawn(spawned_worker, args=(fn, world_size, backend, port, args), nprocs=world_size)
+
+
+def distributed_dataloader(dataset, batch_size, drop_last=True, seed=0):
+    """
+    DataLoader of the shard of `dataset` of this process, with `batch_size // world_size` frames per
+    process so that the global batch is `batch_size`. FluDatasets are split by a DistributedSampler
+    (DDPM.train calls its set_epoch); a CompositeFluDataset is drawn with its weights by each process
+    with its own generator.
+    """
+    world_size, rank = get_world_size(), get_rank()
+    if isinstance(dataset, training_datasets.CompositeFluDataset):
+        sampler = dataset.sampler(
+            generator=torch.Generator().manual_seed(seed + rank),
+            num_samples=dataset.epoch_size // world_size,
+        )
+    else:
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed, drop_last=drop_last)
+    return DataLoader(dataset, batch_size=batch_size // world_size, sampler=sampler, drop_last=drop_last)
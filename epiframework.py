@@ -1,9 +1,14 @@
 import scipy.interpolate
+import hashlib
+import inspect
 import itertools
+import json
+import os
+import collections.abc
 import datetime
 import numpy as np
 import pandas as pd
-import data_utils, training_datasets
+import training_datasets
 import nn_blocks, idplots, ddpm, myutils, inpaint, ground_truth
 
 import sys
@@ -13,9 +18,10 @@ from guided_diffusion import unet
 from utils import config
 
 
-def copaint_config_library(timesteps):
+def copaint_config_dicts(timesteps):
+    """ the CoPaint configurations as plain dicts, as hashed in the forecast cells of main.py """
     config_lib = {
-        "celebahq_try1":config.Config(default_config_dict={
+        "celebahq_try1":{
                             "respace_interpolate": False,
                                 "ddim": {
                                     "ddim_sigma": 0.0,
@@ -44,8 +50,8 @@ def copaint_config_library(timesteps):
                                 
                                 },
                             "debug":False
-                        },  use_argparse=False),
-        "celebahq_noTT":config.Config(default_config_dict={
+                        },
+        "celebahq_noTT":{
                             "respace_interpolate": False,
                                 "ddim": {
                                     "ddim_sigma": 0.0,
@@ -74,8 +80,8 @@ def copaint_config_library(timesteps):
                                 
                                 },
                             "debug":False
-                        },  use_argparse=False),
-        "celebahq_noTT2":config.Config(default_config_dict={
+                        },
+        "celebahq_noTT2":{
                             "respace_interpolate": False,
                                 "ddim": {
                                     "ddim_sigma": 0.0,
@@ -104,8 +110,8 @@ def copaint_config_library(timesteps):
                                 
                                 },
                             "debug":False
-                        },  use_argparse=False),
-        "celebahq_try3":config.Config(default_config_dict={
+                        },
+        "celebahq_try3":{
                             "respace_interpolate": False,
                                 "ddim": {
                                     "ddim_sigma": 0.0,
@@ -133,8 +139,8 @@ def copaint_config_library(timesteps):
                                     "use_smart_lr_xt_decay": True
                                 },
                             "debug":False
-                        },  use_argparse=False),
-        "celebahq":config.Config(default_config_dict={
+                        },
+        "celebahq":{
                             "respace_interpolate": False,
                                 "ddim": {
                                     "ddim_sigma": 0.0,
@@ -162,8 +168,8 @@ def copaint_config_library(timesteps):
                                     "use_smart_lr_xt_decay": True
                                 },
                             "debug":False
-                        },  use_argparse=False),
-        #"imagenet":config.Config(default_config_dict={
+                        },
+        #"imagenet":{
         #                    "respace_interpolate": False,
         #                        "ddim": {
         #                            "ddim_sigma": 0.0,
@@ -192,48 +198,198 @@ def copaint_config_library(timesteps):
         #                        
         #                        },
         #                    "debug":False
-        #                },  use_argparse=False),
+        #                },
     }
     return config_lib
 
 
-def model_libary(image_size, channels, epoch, device, batch_size):
-    unet_spec = {
-        "MyUnet200": ddpm.DDPM(model=nn_blocks.Unet(
-                                    dim=image_size,
-                                    channels=channels,
-                                    dim_mults=(1, 2, 4,),
-                                    use_convnext=False
-                                ), 
-                    image_size=image_size, 
-                    channels=channels, 
-                    batch_size=batch_size, 
-                    epochs=epoch, 
-                    timesteps=200,
-                    device=device),
-        "MyUnet500": ddpm.DDPM(model=nn_blocks.Unet(
-                                    dim=image_size,
-                                    channels=channels,
-                                    dim_mults=(1, 2, 4,),
-                                    use_convnext=False
+def copaint_config_library(timesteps):
+    return {name: config.Config(default_config_dict=conf_dict, use_argparse=False)
+            for name, conf_dict in copaint_config_dicts(timesteps).items()}
+
+
+class LazyLibrary(collections.abc.Mapping):
+    """
+    Read-only mapping name -> object where each object is only built, by calling its factory (a function
+    without arguments), on first access, and then memoized. Iterating over the names builds nothing.
+    Use `build` for a new, not memoized, object (e.g a fresh model for each trained spec).
+    `configs` (name -> function without arguments, also memoized) describe each object as json-able data,
+    for the configuration hashed in the spec manifest (see spec_grid).
+    """
+    def __init__(self, factories, configs=None):
+        self.factories = dict(factories)
+        self.built = {}
+        self.configs = dict(configs or {})
+        self.configs_built = {}
+
+    def config(self, name):
+        if name not in self.configs_built:
+            self.configs_built[name] = self.configs[name]() if name in self.configs else {"name": name}
+        return self.configs_built[name]
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            self.built[name] = self.factories[name]()
+        return self.built[name]
+
+    def build(self, name):
+        return self.factories[name]()
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def __len__(self):
+        return len(self.factories)
+
+
+def spec_grid(file_prefix, unet_spec, dataset_spec, transform_names, enrich_names, scaling_fn=None):
+    """
+    The specs of a run: every (unet, dataset, transform, enrich) combination of the library names, in a
+    stable order that gives the spec_id, with the model_id, a readable label, and the full configuration
+    of the model (Unet config and timesteps, dataset sources, transforms and their code, and the scaling
+    `scaling_fn(dataset_name)` of the dataset when given) with its hash, which names the outputs (see
+    model_folder). Only what determines the trained weights is hashed. Builds nothing.
+    """
+    transform_code = transform_code_hash()
+    specs = []
+    for spec_id, (unet_name, dataset_name, transform_name, enrich_name) in enumerate(
+            itertools.product(unet_spec, dataset_spec, transform_names, enrich_names)):
+        spec_config = {
+            "unet": unet_spec.config(unet_name),
+            "dataset": dataset_spec.config(dataset_name),
+            "transform": transform_name,
+            "enrich": enrich_name,
+            "transform_code": transform_code,
+        }
+        if scaling_fn is not None:
+            spec_config["scaling"] = [float(x) for x in np.asarray(scaling_fn(dataset_name)).ravel()]
+        specs.append({
+            "spec_id": spec_id,
+            "unet": unet_name,
+            "dataset": dataset_name,
+            "transform": transform_name,
+            "enrich": enrich_name,
+            "model_id": f"{file_prefix}::model_{unet_name}::dataset_{dataset_name}::trans_{transform_name}::enrich_{enrich_name}",
+            "config": spec_config,
+            "model_hash": config_hash(spec_config),
+        })
+    return specs
+
+
+def config_hash(config):
+    """ short sha256 of a json-able configuration, independent of the order of the keys """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def transform_code_hash():
+    """ short sha256 of the code of the transforms (transform libraries and transforms.py), a change retrains """
+    import transforms
+    h = hashlib.sha256()
+    for obj in [transform_library, batch_transform_library, transforms]:
+        h.update(inspect.getsource(obj).encode())
+    return h.hexdigest()[:16]
+
+
+def model_folder(outdir, spec):
+    """
+    Content-addressed folder of the outputs of a spec, `<outdir>models/<model_hash>`: a rerun with the
+    same configuration finds its checkpoints and forecasts there, a changed configuration gets a new folder.
+    """
+    return f"{outdir}models/{spec['model_hash']}"
+
+
+def write_spec_manifest(folder, spec, training=None):
+    """
+    `spec.json` of a model folder: the hashed configuration, the labels, the options of the training
+    that are not hashed (`training`, e.g precision) and when and from which revision it was made
+    """
+    manifest_fn = f"{folder}/spec.json"
+    if os.path.exists(manifest_fn):
+        return
+    create_folders(folder)
+    manifest = {key: spec[key] for key in ["model_hash", "model_id", "unet", "dataset", "transform", "enrich", "config"]}
+    manifest["training"] = training or {}
+    manifest["git_revision"] = get_git_revision_short_hash()
+    manifest["created"] = datetime.datetime.now().isoformat()
+    tmp_fn = f"{manifest_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+    os.replace(tmp_fn, manifest_fn)
+
+
+def model_libary(image_size, channels, epoch, device, batch_size, precision="fp32", channels_last=False, ema_decay=None):
+    unet_config = {"dim": image_size, "channels": channels, "dim_mults": [1, 2, 4], "use_convnext": False}
+
+    def config(timesteps):
+        # only what determines the trained weights: the precision and the EMA are options of a training
+        # (recorded in spec.json and in the checkpoint), channels_last is a memory layout
+        return {"unet": unet_config, "timesteps": timesteps, "image_size": image_size, "epochs": epoch,
+                "batch_size": batch_size}
+
+    def build(timesteps):
+        return ddpm.DDPM(model=nn_blocks.Unet(
+                                    dim=unet_config["dim"],
+                                    channels=unet_config["channels"],
+                                    dim_mults=tuple(unet_config["dim_mults"]),
+                                    use_convnext=unet_config["use_convnext"]
                                 ), 
                     image_size=image_size, 
                     channels=channels, 
                     batch_size=batch_size, 
                     epochs=epoch, 
-                    timesteps=500,
-                    device=device)
-    }
+                    timesteps=timesteps,
+                    device=device,
+                    precision=precision,
+                    channels_last=channels_last,
+                    ema_decay=ema_decay)
+
+    unet_spec = LazyLibrary({
+        "MyUnet200": lambda: build(timesteps=200),
+        "MyUnet500": lambda: build(timesteps=500),
+    }, configs={
+        "MyUnet200": lambda: config(timesteps=200),
+        "MyUnet500": lambda: config(timesteps=500),
+    })
     return unet_spec
+
+
 def dataset_library(gt1, channels):
-    dataset_spec = {
-            #"Fv":training_datasets.FluDataset.from_fluview(flusetup=gt1.flusetup, download=False),
-            "R1Fv": training_datasets.FluDataset.from_SMHR1_fluview(flusetup=gt1.flusetup, download=False),
-            "R1": training_datasets.FluDataset.from_csp_SMHR1('Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc', channels=channels)
-    }
+    dataset_spec = LazyLibrary({
+            #"Fv": lambda: training_datasets.FluDataset.from_fluview(season_setup=gt1.flusetup, download=False),
+            "R1Fv": lambda: training_datasets.FluDataset.from_SMHR1_fluview(season_setup=gt1.flusetup, download=False),
+            "R1": lambda: training_datasets.FluDataset.from_csp_SMHR1('Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc', channels=channels)
+            # more sources are mixed without copies, e.g:
+            #"R1FvFs": lambda: training_datasets.CompositeFluDataset([
+            #        training_datasets.FluDataset.from_csp_SMHR1(training_datasets.SMHR1_netcdf_file, channels=1),
+            #        training_datasets.FluDataset.from_fluview(season_setup=gt1.flusetup, channels=1),
+            #        training_datasets.FluDataset.from_flusurvCSP(season_setup=gt1.flusetup, channels=1)],
+            #    weights=[.5, .3, .2], channels=1),
+    }, configs={
+            "R1Fv": lambda: {"sources": [training_datasets.csp_SMHR1_source(training_datasets.SMHR1_netcdf_file, channels=1),
+                                         training_datasets.fluview_source(season_setup=gt1.flusetup)],
+                             "weights": "frames, fluview x90"},
+            "R1": lambda: {"sources": [training_datasets.csp_SMHR1_source('Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc', channels=channels)]},
+    })
     return dataset_spec
 
 
+def dataset_stats_library(gt1, channels):
+    """
+    Same names as dataset_library, but stats-only handles (FluDataset.stats_only): the max per feature
+    is read from the statistics cached next to the sources (training_datasets.cached_stats), without
+    loading the training frames unless a source changed.
+    """
+    dataset_stats_spec = LazyLibrary({
+            #"Fv": lambda: training_datasets.FluDataset.stats_only(training_datasets.fluview_stats(season_setup=gt1.flusetup)["max_per_feature"], channels=channels),
+            "R1Fv": lambda: training_datasets.FluDataset.stats_only(np.maximum(
+                                training_datasets.csp_SMHR1_stats(training_datasets.SMHR1_netcdf_file, channels=1)["max_per_feature"],
+                                training_datasets.fluview_stats(season_setup=gt1.flusetup)["max_per_feature"]), channels=1),
+            "R1": lambda: training_datasets.FluDataset.stats_only(
+                                training_datasets.csp_SMHR1_stats('Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc', channels=channels)["max_per_feature"], channels=channels)
+    })
+    return dataset_stats_spec
+
+
 def get_git_revision_short_hash() -> str:
     import subprocess
     return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip()
@@ -242,6 +398,10 @@ def create_folders(path):
     from pathlib import Path
     Path(path).mkdir(parents=True, exist_ok=True)
 
+def scaling_per_channel(max_per_feature, gt1):
+    """ scale of the transforms: the largest of the dataset (cached) max and of the ground truth """
+    return np.maximum(np.asarray(max_per_feature), np.asarray(gt1.gt_xarr.max(dim=["date", "place"])))
+
 def transform_library(scaling_per_channel):
     from torchvision import transforms
 
@@ -296,6 +456,49 @@ def transform_library(scaling_per_channel):
     return transforms_spec, transform_enrich
 
 
+def batch_transform_library(scaling_per_channel):
+    """
+    Same transforms and enrichments as transform_library (same keys), but applied to a whole
+    (sample, feature, date, place) torch batch with per-sample random parameters, see
+    training_datasets.BatchedFluLoader. The inverse transforms stay the numpy ones of transform_library.
+    """
+    from torchvision.transforms import Compose, Lambda
+    import transforms
+
+    batch_transform_enrich = {
+        "No":Compose([]),
+        "PoisPadScale":Compose([
+                Lambda(lambda t: transforms.batch_poisson(t)),
+                Lambda(lambda t: transforms.batch_random_padintime(t, min_shift = -15, max_shift = 15)),
+                Lambda(lambda t: transforms.batch_randomscale(t, min=.1, max=1.9)),
+        ]),
+        "PoisPadScaleSmall":Compose([
+                Lambda(lambda t: transforms.batch_poisson(t)),
+                Lambda(lambda t: transforms.batch_random_padintime(t, min_shift = -4, max_shift = 4)),
+                Lambda(lambda t: transforms.batch_randomscale(t, min=.7, max=1.3)),
+        ]),
+        "Pois":Compose([
+                Lambda(lambda t: transforms.batch_poisson(t)),
+        ])
+    }
+
+    batch_transforms_spec = {
+        # No scaling (linear scale)
+        "Lins":Compose([
+                Lambda(lambda t: transforms.batch_channelwisescale(t, scale = 1/scaling_per_channel)),
+                Lambda(lambda t: transforms.batch_channelwisescale(t, scale = 2)),
+        ]),
+        # sqrt scale
+        "Sqrt":Compose([
+                Lambda(lambda t: transforms.batch_channelwisescale(t, scale = 1/scaling_per_channel)),
+                transforms.batch_sqrt,
+                Lambda(lambda t: transforms.batch_channelwisescale(t, scale = 2)),
+        ]),
+    }
+
+    return batch_transforms_spec, batch_transform_enrich
+
+
 def create_run_config(run_id, specifications):
 
     if setup.scale == 'Regions':
@@ -1,4 +1,6 @@
 import math
+import pickle
+import functools
 from inspect import isfunction
 from functools import partial
 from pathlib import Path
@@ -13,7 +15,8 @@ import xarray as xr
 
 import datetime
 
-import myutils, data_utils
+import myutils, build_dataset
+from season_setup import SeasonSetup
 
 
 class GroundTruth():
@@ -25,30 +28,26 @@ class GroundTruth():
         self.image_size=image_size
 
 
-        if not nogit: self.git_checkout_data_rev(target_date=None)
-
         if self.season_first_year == "2023":
-            self.flusetup = data_utils.FluSetup.from_flusight2023_24(fluseason_startdate=pd.to_datetime("2023-07-24"), remove_territories=True)
-            flusight = data_utils.get_from_epidata(dataset="flusight2023_24", flusetup=self.flusetup, write=False)
+            self.flusetup = SeasonSetup.from_flusight(fluseason_startdate=pd.to_datetime("2023-07-24"), remove_territories=True)
+            flusight = build_dataset.get_from_epidata(dataset="flusight2023_24", season_setup=self.flusetup, write=False)
             gt_df_final = flusight[flusight["fluseason"] == 2023]
             if from_final_data:
                 gt_df = gt_df_final.copy()
             else:
-                if not nogit: self.git_checkout_data_rev(target_date=data_date)
-                flusight = data_utils.get_from_epidata(dataset="flusight2023_24", flusetup=self.flusetup, write=False)
+                # data vintage of data_date, read from the git objects of the data repository without checkout
+                flusight = build_dataset.get_from_epidata(dataset="flusight2023_24", season_setup=self.flusetup, write=False, vintage_date=None if nogit else data_date)
                 gt_df = flusight[flusight["fluseason"] == 2023]   
-                if not nogit: self.git_checkout_data_rev(target_date=None)
         elif self.season_first_year == "2022":
-            self.flusetup = data_utils.FluSetup.from_flusight2023_24(fluseason_startdate=pd.to_datetime("2022-07-24"), remove_territories=True)
-            flusight = data_utils.get_from_epidata(dataset="flusight2022_23", flusetup=self.flusetup, write=False)
+            self.flusetup = SeasonSetup.from_flusight(fluseason_startdate=pd.to_datetime("2022-07-24"), remove_territories=True)
+            flusight = build_dataset.get_from_epidata(dataset="flusight2022_23", season_setup=self.flusetup, write=False)
             gt_df_final = flusight[flusight["fluseason"] == 2022]
             if from_final_data:
                 gt_df = gt_df_final.copy()
             else:
-                if not nogit: self.git_checkout_data_rev(target_date=data_date)
-                flusight = data_utils.get_from_epidata(dataset="flusight2022_23", flusetup=self.flusetup, write=False)
+                # data vintage of data_date, read from the git objects of the data repository without checkout
+                flusight = build_dataset.get_from_epidata(dataset="flusight2022_23", season_setup=self.flusetup, write=False, vintage_date=None if nogit else data_date)
                 gt_df = flusight[flusight["fluseason"] == 2022]
-                if not nogit: self.git_checkout_data_rev(target_date=None)  
         else:
             raise ValueError("not supported")
         
@@ -56,11 +55,11 @@ class GroundTruth():
         self.gt_df_final = gt_df_final[gt_df_final["location_code"].isin(self.flusetup.locations)]
 
 
-        self.gt_xarr = data_utils.dataframe_to_xarray(self.gt_df, flusetup=self.flusetup, 
+        self.gt_xarr = build_dataset.dataframe_to_xarray(self.gt_df, season_setup=self.flusetup, 
             xarray_name = "gt_flusight_incidHosp", 
             xarrax_features = "incidHosp")
         
-        self.gt_final_xarr = data_utils.dataframe_to_xarray(self.gt_df_final, flusetup=self.flusetup, 
+        self.gt_final_xarr = build_dataset.dataframe_to_xarray(self.gt_df_final, season_setup=self.flusetup, 
             xarray_name = "gt_flusight_incidHos_final", 
             xarrax_features = "incidHosp")
 
@@ -76,38 +75,6 @@ class GroundTruth():
         print(f"Masking, >> {self.inpaintfrom_idx} weeks already in data, inpainting the next ones")
 
     
-    def git_checkout_data_rev(self, target_date=None):
-        import pygit2
-        if self.season_first_year == "2023":
-            repo_path = "Flusight/FluSight-forecast-hub/"
-            main_branch = "main"
-        elif  self.season_first_year == "2022":
-            repo_path = "Flusight/Flusight-forecast-data/"
-            main_branch = "master"
-
-
-        # Open the existing repository
-        repo = pygit2.Repository(repo_path)
-
-        if target_date is not None:
-            # Find the commit closest to the target date
-            closest_commit = None
-            for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TIME):
-                if commit.commit_time <= target_date.timestamp():
-                    closest_commit = commit
-                    break
-
-            # Check out the commit
-            if closest_commit:
-                repo.checkout_tree(closest_commit.tree)
-                repo.set_head(closest_commit.id)
-                print(f"Checked out commit on {target_date} (SHA: {closest_commit.id}, {commit.commit_time}) for repo {repo_path}")
-            else:
-                print("ERROR: No commit found for the specified date on repo {repo_path}.")
-        else:
-            repo.checkout("refs/heads/" + main_branch)      
-            print(f"Restored git repo {repo_path}")
-
     def plot(self):
         fig, axes = plt.subplots(13, 4, sharex=True, figsize=(12,24))
         gt_piv  = self.gt_df.pivot(index = "week_enddate", columns='location_code', values='value')
@@ -150,7 +117,48 @@ class GroundTruth():
         axes[3].imshow(self.gt_keep_mask[0], alpha=.3, cmap = "rainbow")
         axes[3].set_title("Final data", fontsize=8)
 
-    def export_forecasts(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None, save_plot=True, nochecks=False):
+    def quantile_table(self, fluforecasts_ti, forecasts_national, target_dates):
+        """
+        Long-format table (target_end_date, location, quantile, value) of the flusight quantiles of the forecasts
+        for the target dates, for each location and the US. All quantiles are computed in one np.quantile call,
+        restricted to the target weeks and the real locations. Rows are ordered by quantile, then location,
+        then target date. Also returns the quantile array (n_quantiles, n_locations + 1, n_target_dates).
+        """
+        season_dates = pd.date_range(self.flusetup.fluseason_startdate, self.flusetup.fluseason_startdate + datetime.timedelta(days=64*7), freq="W-SAT")
+        target_idx = season_dates.get_indexer(target_dates)
+        if (target_idx < 0).any():
+            raise KeyError(f"target dates {list(target_dates[target_idx < 0])} are not in the season")
+        n_places = len(self.flusetup.locations)
+
+        values = np.concatenate([
+            fluforecasts_ti[:, 0, target_idx, :n_places],
+            forecasts_national[:, 0, target_idx, np.newaxis],
+        ], axis=-1)  # (n_samples, n_target_dates, n_places + 1)
+        quantile_values = np.quantile(values, myutils.flusight_quantiles, axis=0).transpose(0, 2, 1)
+
+        locations = list(self.flusetup.locations) + ["US"]
+        n_qt, n_loc, n_dates = quantile_values.shape
+        df = pd.DataFrame({
+            "target_end_date": np.tile(np.asarray(target_dates), n_qt * n_loc),
+            "location": np.tile(np.repeat(locations, n_dates), n_qt),
+            "quantile": np.repeat(myutils.flusight_quantiles, n_loc * n_dates),
+            "value": quantile_values.ravel(),
+        })
+        return df, quantile_values
+
+    def check_quantiles_monotonic(self, quantile_values, target_dates):
+        """ check on the quantile array of `quantile_table` that values are non-decreasing (and non-negative) as quantiles increase """
+        locations = list(self.flusetup.locations) + ["US"]
+        steps = np.diff(quantile_values, axis=0, prepend=0)  # the first quantile is compared to 0
+        for iqt, iloc, idate in zip(*np.nonzero(steps < 0)):
+            p = locations[iloc]
+            if "US" not in p:
+                p = p + self.flusetup.get_location_name(p)
+            print(f""" !!!! failed for {myutils.flusight_quantiles[iqt]:.3f} on date {target_dates[idate]}: {p}, """
+                  f"""{quantile_values[iqt, iloc, idate]} < {quantile_values[iqt-1, iloc, idate] if iqt > 0 else 0}""")
+        return not (steps < 0).any()
+
+    def export_forecasts(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None, save_plot=True, nochecks=False, defer_plot=False):
         forecast_date_str=str(forecast_date)
         if forecast_date == None:
             forecast_date = self.mask_date
@@ -163,21 +171,9 @@ class GroundTruth():
 
         print(target_dates)
         #pd.DataFrame(colums=["forecast_date","target_end_date","location","type","quantile","value","target"])
-        df_list=[]
-        for qt in myutils.flusight_quantiles:
-            a =  pd.DataFrame(np.quantile(fluforecasts_ti[:,:,:,:len(self.flusetup.locations)], qt, axis=0)[0], 
-                    columns= self.flusetup.locations, index=pd.date_range(self.flusetup.fluseason_startdate, self.flusetup.fluseason_startdate + datetime.timedelta(days=64*7), freq="W-SAT")).loc[target_dates]
-            #a["US"] = a.sum(axis=1)
-            a["US"] = pd.DataFrame(np.quantile(forecasts_national, qt, axis=0)[0],
-                    columns= ["US"], index=pd.date_range(self.flusetup.fluseason_startdate, self.flusetup.fluseason_startdate + datetime.timedelta(days=64*7), freq="W-SAT")).loc[target_dates]
-
-            a = a.reset_index().rename(columns={'index': 'target_end_date'})
-            a = pd.melt(a,id_vars="target_end_date",var_name="location")
-            a["quantile"] = '{:<.3f}'.format(qt)
-            
-            df_list.append(a)
-
-        df = pd.concat(df_list)
+        df, quantile_values = self.quantile_table(fluforecasts_ti, forecasts_national, target_dates)
+        df["quantile"] = df["quantile"].map('{:<.3f}'.format)
+
         df["forecast_date"] = forecast_date_str
         df["type"] = "quantile"
         df["target"] = df["target_end_date"].map(target_dict)
@@ -193,164 +189,59 @@ class GroundTruth():
             assert sum(df["value"].isna()) == 0
 
         # check for Error when validating format: Entries in `value` must be non-decreasing as quantiles increase:
-        for tg in target_dates:
-            old_vals = np.zeros(len(self.flusetup.locations)+1)
-            for dfd in df_list:  # very important to not call this df: it overwrites in namesapce the exported df
-                new_vals = dfd[dfd["target_end_date"]==tg]["value"].to_numpy()
-                if not (new_vals-old_vals >= 0).all():
-                    print(f""" !!!! failed for {dfd["quantile"].unique()} on date {tg}""")
-                    print((new_vals-old_vals).max())
-                    for n, o, p in zip(new_vals, old_vals, dfd.location.unique()):
-                        if "US" not in p:
-                            p=p+self.flusetup.get_location_name(p)
-                        print((n-o>0),p, n, o)
-                else:
-                    pass
-                    #print(f"""ok for {dfd["quantile"].unique()}, {tg}""")
-                old_vals = new_vals
+        self.check_quantiles_monotonic(quantile_values, target_dates)
 
         df.to_csv(f"{directory}/{prefix}-{forecast_date_str}.csv", index=False)
 
         if save_plot:
-            self.plot_forecasts(fluforecasts_ti, forecasts_national, directory=directory, prefix=prefix, forecast_date=forecast_date)
+            return self.plot_forecasts(fluforecasts_ti, forecasts_national, directory=directory, prefix=prefix, forecast_date=forecast_date, defer=defer_plot)
         
-    def plot_forecasts(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None):
+    def export_stored_forecasts(self, sample_store, model_id, inpaint_config, forecast_date, export_2023=False, **kwargs):
+        """
+        export_forecasts (or export_forecasts_2023) and plots from the ensemble persisted in a sample_store.SampleStore,
+        instead of in-memory samples. Only the stored weeks and real places are read.
+        """
+        fluforecasts_ti, forecasts_national = sample_store.read_forecasts(model_id, inpaint_config, forecast_date, frame_size=self.image_size)
+        export = self.export_forecasts_2023 if export_2023 else self.export_forecasts
+        return export(fluforecasts_ti=fluforecasts_ti, forecasts_national=forecasts_national, forecast_date=forecast_date, **kwargs)
+
+    def plot_forecasts(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None, defer=False, n_workers=None):
+        """
+        Plot the forecasts ("all" and "50-95" quantile ranges) for the nation and each state. All quantiles
+        are computed once here, then the pdfs are rendered by render_forecast_plots, in a process pool.
+        If `defer`, the plot job (quantiles and ground-truth, without the samples) is only pickled next to
+        the csv and its filename returned, to be rendered later with render_forecast_plots.
+        """
+        job = self.forecast_plot_job(fluforecasts_ti, forecasts_national, directory=directory, prefix=prefix, forecast_date=forecast_date)
+        if defer:
+            job_fn = f"{job['output_prefix']}-plotjob.pkl"
+            with open(job_fn, "wb") as f:
+                pickle.dump(job, f)
+            return job_fn
+        render_forecast_plots([job], n_workers=n_workers)
+
+    def forecast_plot_job(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None):
+        """ everything needed to render the plots of a forecast, see render_forecast_plot """
         forecast_date_str=str(forecast_date)
-        if forecast_date == None:
-            forecast_date = self.mask_date
-        idx_now = self.inpaintfrom_idx-1
-        idx_horizon = idx_now+4
-
-        plot_specs = {"all" : {
-                                "quantiles_idx":range(11),
-                                "color":"lightcoral",
-                                },
-                        "50-95" : {
-                                "quantiles_idx":[1, 6],
-                                "color":"darkblue"
-                                }
-                    }
-
-        color_gt = "black"
-        color_past='grey'
-
         nplace_toplot = 51
         #nplace_toplot = 3 # less plots for faster iteration
-        plot_past_median = False
-        if plot_past_median:
-            plotrange=slice(None)
-        else:
-            plotrange=slice(self.inpaintfrom_idx,-1)
-
 
         if self.season_first_year == "2023":
-            gt2022 = GroundTruth(season_first_year="2022", 
-                            data_date=datetime.datetime.today(),
-                            mask_date=datetime.datetime.today(),
-                            channels=self.channels,
-                            image_size=self.image_size
-                            )
-
-        for plot_title, plot_spec in plot_specs.items():
-            #print(f"doing {plot_title}...")
-            fig, axes = plt.subplots(nplace_toplot+1, 2, figsize=(10,nplace_toplot*3.5), dpi=200)
-            for iax in range(2):
-                ax = axes[0][iax]
-    
-                x = np.arange(64)
-                if iax == 0:
-                    x_lims = (0, 52)
-                elif iax == 1:
-                    x_lims = (idx_now-3, idx_horizon)
-    
-                # US WIDE: quantiles and median, US-wide
-                for iqt in plot_spec["quantiles_idx"]:
-                    #print(f"up: {flusight_quantile_pairs[iqt,0]} - lo: {flusight_quantile_pairs[iqt,1]}")
-                    # TODO: not exactly true that it is the sum of quantiles (sum of quantile is not quantile of sum)
-                    ylo = np.quantile(forecasts_national, myutils.flusight_quantile_pairs[iqt,0], axis=0)[0]
-                    yup = np.quantile(forecasts_national, myutils.flusight_quantile_pairs[iqt,1], axis=0)[0]
-                    ax.fill_between(x[plotrange], 
-                                    ylo[plotrange], 
-                                    yup[plotrange], 
-                                    alpha=.1, 
-                                    color=plot_spec["color"])
-    
-                    # widest quantile pair is the first one. We take the up quantile of it + a few % as x_lim
-                    if iqt == plot_spec["quantiles_idx"][0]:
-                        if plot_past_median:
-                            max_y_value = max(yup[x_lims[0]:x_lims[1]])
-                        else:
-                            max_y_value = max(yup[self.inpaintfrom_idx:x_lims[1]])
-                        max_y_value = max(max_y_value, self.gt_xarr.data[0,:self.inpaintfrom_idx].sum(axis=1)[x_lims[0]:x_lims[1]].max())
-                        max_y_value = max_y_value + max_y_value*.05 # 10% more
-    
-                # median
-                ax.plot(x[plotrange], np.quantile(forecasts_national, myutils.flusight_quantiles[12], axis=0)[0][plotrange], color=plot_spec["color"], marker='.', label='forecast median')
-    
-                # ground truth
-                ax.plot(self.gt_xarr.data[0,:self.inpaintfrom_idx].sum(axis=1), color=color_gt, marker = '.', lw=.5, label='ground-truth')
-                if self.season_first_year == "2023":
-                    ax.plot(gt2022.gt_xarr.data[0,:].sum(axis=1), color=color_past, ls='dashed', lw=.5, label='2022 ground-truth')
-
-                if iax==0:
-                    ax.legend(fontsize=8)
-    
-                #ax.set_xticks(np.arange(0,53,13))
-
-
-                ax.set_xlim(x_lims)
-                ax.set_ylim(bottom=0, top=max_y_value)
-                ax.axvline(idx_now, c='k', lw=1, ls='-.')
-                if iax == 0:
-                    ax.axvline(idx_horizon, c='k', lw=1, ls='-.')
-                ax.set_title("National")
-
-                sns.despine(ax = ax, trim = True, offset=4)
-
-                # INDIVDIDUAL STATES: quantiles, median and ground-truth
-                max_y_value = np.zeros(52)
-                for iqt in plot_spec["quantiles_idx"]:
-                    yup = np.quantile(fluforecasts_ti, myutils.flusight_quantile_pairs[iqt,0], axis=0)[0]
-                    ylo = np.quantile(fluforecasts_ti, myutils.flusight_quantile_pairs[iqt,1], axis=0)[0]
-
-                    # widest quantile pair is the first one. We take the up quantile of it + a few % as x_lim
-                    if iqt == plot_spec["quantiles_idx"][0]:
-                        for ipl in range(nplace_toplot):
-                            if plot_past_median:
-                                max_y_value[ipl] = max(ylo[x_lims[0]:x_lims[1], ipl])
-                            else:
-                                max_y_value[ipl] = max(ylo[self.inpaintfrom_idx:x_lims[1], ipl])
-                            #max_y_value[ipl] =  max(ylo[x_lims[:x_lims[1], ipl])
-                            max_y_value[ipl] = max(max_y_value[ipl], self.gt_xarr.data[0,:self.inpaintfrom_idx, ipl][x_lims[0]:x_lims[1]].max())
-                            max_y_value[ipl] = max_y_value[ipl] + max_y_value[ipl]*.05 # 10% more for the y_max value
-
-                    for ipl in range(nplace_toplot):
-                        ax = axes[ipl+1][iax]
-                        ax.fill_between((x)[plotrange],  (yup[:,ipl])[plotrange], (ylo[:,ipl])[plotrange], alpha=.1, color=plot_spec["color"])
-
-                # median line and ground truth for states
-                for ipl in range(nplace_toplot):   
-                    ax = axes[ipl+1][iax]
-                    # median
-                    ax.plot(np.arange(64)[plotrange],
-                            np.quantile(fluforecasts_ti, myutils.flusight_quantiles[12], axis=0)[0,:,ipl][plotrange], color=plot_spec["color"], marker = '.', lw=.5)
-                    # ground truth
-                    ax.plot(self.gt_xarr.data[0,:self.inpaintfrom_idx, ipl], color=color_gt, marker = '.', lw=.5)
-                    if self.season_first_year == "2023":
-                        ax.plot(gt2022.gt_xarr.data[0,:, ipl], color=color_past, ls='dashed', lw=.5)
-
-                    ax.axvline(idx_now, c='k', lw=1, ls='-.')
-                    if iax == 0:
-                        ax.axvline(idx_horizon, c='k', lw=1, ls='-.')
-                    ax.set_xlim(x_lims)
-                    ax.set_ylim(bottom=0, top=max_y_value[ipl])
-                    if iax==0: ax.set_ylabel("New Hosp. Admissions")
-                    ax.set_title(self.flusetup.get_location_name(self.flusetup.locations[ipl]))
-                    sns.despine(ax = ax, trim = True, offset=4)
-            fig.tight_layout()
-            plt.savefig(f"{directory}/{prefix}-{forecast_date_str}-plot{plot_title}.pdf")
-
-    def export_forecasts_2023(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None, save_plot=True, nochecks=False, rate_trend=True):
+            gt_reference = get_reference_gt_data(season_first_year="2022", channels=self.channels, image_size=self.image_size)
+        else:
+            gt_reference = None
+
+        return {
+            "output_prefix": f"{directory}/{prefix}-{forecast_date_str}",
+            "quantiles_national": np.quantile(forecasts_national, myutils.flusight_quantiles, axis=0)[:, 0],
+            "quantiles_states": np.quantile(fluforecasts_ti[:, :, :, :nplace_toplot], myutils.flusight_quantiles, axis=0)[:, 0],
+            "gt_data": self.gt_xarr.data[0],
+            "gt_reference": gt_reference,
+            "inpaintfrom_idx": self.inpaintfrom_idx,
+            "location_names": [self.flusetup.get_location_name(pl) for pl in self.flusetup.locations[:nplace_toplot]],
+        }
+
+    def export_forecasts_2023(self, fluforecasts_ti, forecasts_national, directory=".", prefix="", forecast_date=None, save_plot=True, nochecks=False, rate_trend=True, defer_plot=False):
         forecast_date_str=str(forecast_date)
         if forecast_date == None:
             forecast_date = self.mask_date
@@ -363,21 +254,9 @@ class GroundTruth():
 
         print(target_dates)
 
-        df_list=[]
-        for qt in myutils.flusight_quantiles:
-            a =  pd.DataFrame(np.quantile(fluforecasts_ti[:,:,:,:len(self.flusetup.locations)], qt, axis=0)[0], 
-                    columns= self.flusetup.locations, index=pd.date_range(self.flusetup.fluseason_startdate, self.flusetup.fluseason_startdate + datetime.timedelta(days=64*7), freq="W-SAT")).loc[target_dates]
-            #a["US"] = a.sum(axis=1)
-            a["US"] = pd.DataFrame(np.quantile(forecasts_national, qt, axis=0)[0],
-                    columns= ["US"], index=pd.date_range(self.flusetup.fluseason_startdate, self.flusetup.fluseason_startdate + datetime.timedelta(days=64*7), freq="W-SAT")).loc[target_dates]
-
-            a = a.reset_index().rename(columns={'index': 'target_end_date'})
-            a = pd.melt(a,id_vars="target_end_date",var_name="location")
-            a["output_type_id"] = "{:.3f}".format(qt).rstrip('0').rstrip('.')# " #'{:<.3f}'.format(qt)
-            
-            df_list.append(a)
-
-        df = pd.concat(df_list)
+        df, quantile_values = self.quantile_table(fluforecasts_ti, forecasts_national, target_dates)
+        df["output_type_id"] = df["quantile"].map(lambda qt: "{:.3f}".format(qt).rstrip('0').rstrip('.'))# " #'{:<.3f}'.format(qt)
+
         df["reference_date"] = forecast_date_str
         df["target"] = "wk inc flu hosp"
         df["horizon"] = df["target_end_date"].map(target_dict)
@@ -394,21 +273,7 @@ class GroundTruth():
             assert sum(df["value"].isna()) == 0
 
         # check for Error when validating format: Entries in `value` must be non-decreasing as quantiles increase:
-        for tg in target_dates:
-            old_vals = np.zeros(len(self.flusetup.locations)+1)
-            for dfd in df_list:  # very important to not call this df: it overwrites in namesapce the exported df
-                new_vals = dfd[dfd["target_end_date"]==tg]["value"].to_numpy()
-                if not (new_vals-old_vals >= 0).all():
-                    print(f""" !!!! failed for {dfd["quantile"].unique()} on date {tg}""")
-                    print((new_vals-old_vals).max())
-                    for n, o, p in zip(new_vals, old_vals, dfd.location.unique()):
-                        if "US" not in p:
-                            p=p+self.flusetup.get_location_name(p)
-                        print((n-o>0),p, n, o)
-                else:
-                    pass
-                    #print(f"""ok for {dfd["quantile"].unique()}, {tg}""")
-                old_vals = new_vals
+        self.check_quantiles_monotonic(quantile_values, target_dates)
 
 #        if rate_trend:
 #            df_list=[]
@@ -436,5 +301,155 @@ class GroundTruth():
         df.to_csv(f"{directory}/{forecast_date_str}-{prefix}.csv", index=False)
 
         if save_plot:
-            self.plot_forecasts(fluforecasts_ti, forecasts_national, directory=directory, prefix=prefix, forecast_date=forecast_date)
+            return self.plot_forecasts(fluforecasts_ti, forecasts_national, directory=directory, prefix=prefix, forecast_date=forecast_date, defer=defer_plot)
         
+
+
+@functools.lru_cache(maxsize=None)
+def get_reference_gt_data(season_first_year, channels=1, image_size=64):
+    """ ground-truth array of a past season, plotted as reference: built once per process """
+    gt_reference = GroundTruth(season_first_year=season_first_year, 
+                            data_date=datetime.datetime.today(),
+                            mask_date=datetime.datetime.today(),
+                            channels=channels,
+                            image_size=image_size
+                            )
+    return gt_reference.gt_xarr.data[0]
+
+
+plot_specs = {"all" : {
+                        "quantiles_idx":range(11),
+                        "color":"lightcoral",
+                        },
+                "50-95" : {
+                        "quantiles_idx":[1, 6],
+                        "color":"darkblue"
+                        }
+            }
+
+
+def render_forecast_plots(jobs, n_workers=None):
+    """
+    Render the pdfs of forecast plot jobs (dicts from GroundTruth.forecast_plot_job or the pickled
+    files written by plot_forecasts(defer=True)), one process per (job, plot spec).
+    """
+    tasks = [(job, plot_title) for job in jobs for plot_title in plot_specs]
+    if n_workers == 1 or len(tasks) == 1:
+        return [render_forecast_plot(job, plot_title) for job, plot_title in tasks]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(render_forecast_plot, *zip(*tasks)))
+
+
+def render_forecast_plot(job, plot_title):
+    if isinstance(job, str):
+        with open(job, "rb") as f:
+            job = pickle.load(f)
+    plot_spec = plot_specs[plot_title]
+    qt_national = job["quantiles_national"]
+    qt_states = job["quantiles_states"]
+    gt_data = job["gt_data"]
+    gt_reference = job["gt_reference"]
+    inpaintfrom_idx = job["inpaintfrom_idx"]
+    nplace_toplot = len(job["location_names"])
+    n_qt = len(myutils.flusight_quantiles)
+
+    idx_now = inpaintfrom_idx-1
+    idx_horizon = idx_now+4
+
+    color_gt = "black"
+    color_past='grey'
+
+    plot_past_median = False
+    if plot_past_median:
+        plotrange=slice(None)
+    else:
+        plotrange=slice(inpaintfrom_idx,-1)
+
+    #print(f"doing {plot_title}...")
+    fig, axes = plt.subplots(nplace_toplot+1, 2, figsize=(10,nplace_toplot*3.5), dpi=200)
+    for iax in range(2):
+        ax = axes[0][iax]
+
+        x = np.arange(64)
+        if iax == 0:
+            x_lims = (0, 52)
+        elif iax == 1:
+            x_lims = (idx_now-3, idx_horizon)
+
+        # US WIDE: quantiles and median, US-wide
+        for iqt in plot_spec["quantiles_idx"]:
+            # flusight_quantile_pairs[iqt] are the quantiles iqt and n_qt-1-iqt
+            # TODO: not exactly true that it is the sum of quantiles (sum of quantile is not quantile of sum)
+            ylo = qt_national[iqt]
+            yup = qt_national[n_qt-1-iqt]
+            ax.fill_between(x[plotrange], 
+                            ylo[plotrange], 
+                            yup[plotrange], 
+                            alpha=.1, 
+                            color=plot_spec["color"])
+
+            # widest quantile pair is the first one. We take the up quantile of it + a few % as x_lim
+            if iqt == plot_spec["quantiles_idx"][0]:
+                if plot_past_median:
+                    max_y_value = max(yup[x_lims[0]:x_lims[1]])
+                else:
+                    max_y_value = max(yup[inpaintfrom_idx:x_lims[1]])
+                max_y_value = max(max_y_value, gt_data[:inpaintfrom_idx].sum(axis=1)[x_lims[0]:x_lims[1]].max())
+                max_y_value = max_y_value + max_y_value*.05 # 10% more
+
+        # median
+        ax.plot(x[plotrange], qt_national[12][plotrange], color=plot_spec["color"], marker='.', label='forecast median')
+
+        # ground truth
+        ax.plot(gt_data[:inpaintfrom_idx].sum(axis=1), color=color_gt, marker = '.', lw=.5, label='ground-truth')
+        if gt_reference is not None:
+            ax.plot(gt_reference.sum(axis=1), color=color_past, ls='dashed', lw=.5, label='2022 ground-truth')
+
+        if iax==0:
+            ax.legend(fontsize=8)
+
+        ax.set_xlim(x_lims)
+        ax.set_ylim(bottom=0, top=max_y_value)
+        ax.axvline(idx_now, c='k', lw=1, ls='-.')
+        if iax == 0:
+            ax.axvline(idx_horizon, c='k', lw=1, ls='-.')
+        ax.set_title("National")
+
+        sns.despine(ax = ax, trim = True, offset=4)
+
+        # INDIVDIDUAL STATES: quantiles, median and ground-truth
+        first_qt = plot_spec["quantiles_idx"][0]
+        widest_up = qt_states[n_qt-1-first_qt]
+        if plot_past_median:
+            max_y_value = widest_up[x_lims[0]:x_lims[1]].max(axis=0)
+        else:
+            max_y_value = widest_up[inpaintfrom_idx:x_lims[1]].max(axis=0)
+        max_y_value = np.maximum(max_y_value, gt_data[:inpaintfrom_idx, :nplace_toplot][x_lims[0]:x_lims[1]].max(axis=0))
+        max_y_value = max_y_value + max_y_value*.05 # 10% more for the y_max value
+
+        for ipl in range(nplace_toplot):
+            ax = axes[ipl+1][iax]
+            for iqt in plot_spec["quantiles_idx"]:
+                ax.fill_between((x)[plotrange],  qt_states[iqt][:,ipl][plotrange], qt_states[n_qt-1-iqt][:,ipl][plotrange], alpha=.1, color=plot_spec["color"])
+
+            # median
+            ax.plot(np.arange(64)[plotrange],
+                    qt_states[12][:,ipl][plotrange], color=plot_spec["color"], marker = '.', lw=.5)
+            # ground truth
+            ax.plot(gt_data[:inpaintfrom_idx, ipl], color=color_gt, marker = '.', lw=.5)
+            if gt_reference is not None:
+                ax.plot(gt_reference[:, ipl], color=color_past, ls='dashed', lw=.5)
+
+            ax.axvline(idx_now, c='k', lw=1, ls='-.')
+            if iax == 0:
+                ax.axvline(idx_horizon, c='k', lw=1, ls='-.')
+            ax.set_xlim(x_lims)
+            ax.set_ylim(bottom=0, top=max_y_value[ipl])
+            if iax==0: ax.set_ylabel("New Hosp. Admissions")
+            ax.set_title(job["location_names"][ipl])
+            sns.despine(ax = ax, trim = True, offset=4)
+    fig.tight_layout()
+    fig.savefig(f"{job['output_prefix']}-plot{plot_title}.pdf")
+    plt.close(fig)
+    return f"{job['output_prefix']}-plot{plot_title}.pdf"
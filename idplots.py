@@ -15,7 +15,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-import data_utils, training_datasets
+import training_datasets
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from torchvision.utils import save_image
@@ -15,7 +15,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-import data_utils, training_datasets
+import training_datasets
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from torchvision.utils import save_image
@@ -25,23 +25,58 @@ import datetime
 import myutils
 
 
+def batch_gt(gt, gt_keep_mask, samples_per_gt):
+    """
+    Expand a stack of ground-truths (n_gt, channels, h, w), e.g one per forecast date, and their
+    keep masks (same shape, or (channels, h, w) if shared) to a batch of `n_gt * samples_per_gt`
+    frames ordered by ground-truth, so that several forecasts share one reverse chain.
+    Works for both REpaint and the CoPaint `model_kwargs`.
+    """
+    if gt_keep_mask.dim() == 3:
+        gt_keep_mask = gt_keep_mask.unsqueeze(0).expand(gt.shape[0], *gt_keep_mask.shape)
+    return (
+        gt.repeat_interleave(samples_per_gt, dim=0),
+        gt_keep_mask.repeat_interleave(samples_per_gt, dim=0),
+    )
+
+
+def split_per_gt(samples, n_gt):
+    """ inverse of batch_gt for the sampled batch: (n_gt * samples_per_gt, ...) -> (n_gt, samples_per_gt, ...) """
+    return samples.reshape(n_gt, samples.shape[0] // n_gt, *samples.shape[1:])
+
+
 class REpaint:
-    def __init__(self, ddpm, gt, gt_keep_mask, resampling_steps=1):
+    def __init__(self, ddpm, gt, gt_keep_mask, resampling_steps=1, samples_per_gt=None, use_ema=None):
+        """
+        `gt` and `gt_keep_mask` are either a single (channels, h, w) frame shared by the whole batch, or a
+        stack (n_gt, channels, h, w) of frames (e.g one per forecast date), each inpainted `samples_per_gt`
+        times (default: ddpm.batch_size) in the same batched reverse process. Use `split_per_gt` on the output.
+        `use_ema`: inpaint with the EMA (True) or raw (False) weights of ddpm, default: ddpm.use_ema.
+        """
         self.ddpm=ddpm
-        self.gt = gt
-        self.gt_keep_mask = gt_keep_mask
         self.resampling_steps = resampling_steps
+        self.use_ema = use_ema
+        if gt.dim() == 4:
+            if samples_per_gt is None:
+                samples_per_gt = self.ddpm.batch_size
+            self.n_gt = gt.shape[0]
+            self.gt, self.gt_keep_mask = batch_gt(gt, gt_keep_mask, samples_per_gt)
+            self.batch_size = self.n_gt * samples_per_gt
+        else:
+            self.n_gt = 1
+            self.gt = gt
+            self.gt_keep_mask = gt_keep_mask
+            self.batch_size = self.ddpm.batch_size
 
     @torch.no_grad()
     def p_sample_paint(self, x, t, t_index):
-        # timestep parameters
-        betas_t = myutils.extract(self.ddpm.betas, t, x.shape)
-        sqrt_one_minus_alphas_cumprod_t = myutils.extract(
-            self.ddpm.sqrt_one_minus_alphas_cumprod, t, x.shape
-        )
-        sqrt_recip_alphas_t = myutils.extract(self.ddpm.sqrt_recip_alphas, t, x.shape)
+        # timestep parameters, all t in the batch are equal to t_index
+        coefs = self.ddpm.step_coefficients[t_index]
+        betas_t = coefs["betas"]
+        sqrt_one_minus_alphas_cumprod_t = coefs["sqrt_one_minus_alphas_cumprod"]
+        sqrt_recip_alphas_t = coefs["sqrt_recip_alphas"]
 
-        posterior_variance_t = myutils.extract(self.ddpm.posterior_variance, t, x.shape)
+        posterior_variance_t = coefs["posterior_variance"]
 
         for u in range(self.resampling_steps):
             # RePaint algorithm, line 4 and 6
@@ -61,27 +96,24 @@ class REpaint:
             # RePaint algorithm, line 4 and 7
             x_tminus1_unknow = (
                 sqrt_recip_alphas_t
-                * (x - betas_t * self.ddpm.model(x, t) / sqrt_one_minus_alphas_cumprod_t)
-                + torch.sqrt(posterior_variance_t) * z
+                * (x - betas_t * self.ddpm.model_fn(x, t) / sqrt_one_minus_alphas_cumprod_t)
+                + math.sqrt(posterior_variance_t) * z
             )
 
             x_tminus1 = x_tminus1_known * self.gt_keep_mask + x_tminus1_unknow * (
                 1 - self.gt_keep_mask
-            ) * 1 / torch.sqrt(1 - posterior_variance_t)
+            ) * 1 / math.sqrt(1 - posterior_variance_t)
 
             # TODO This is used for debug: return the full infered dynamics.
             if t_index == 0:
-                x_tminus1 = x_tminus1_unknow * 1 / torch.sqrt(1 - posterior_variance_t)
+                x_tminus1 = x_tminus1_unknow * 1 / math.sqrt(1 - posterior_variance_t)
 
-            if u < self.resampling_steps - 1 and (t > 1).all():
+            if u < self.resampling_steps - 1 and t_index > 1:
                 # taken from q_sample:
                 noise = torch.randn_like(x)
-                sqrt_alphas_cumprod_t = myutils.extract(
-                    self.ddpm.sqrt_alphas_cumprod, t - 1, x.shape
-                )
-                sqrt_one_minus_alphas_cumprod_t = myutils.extract(
-                    self.ddpm.sqrt_one_minus_alphas_cumprod, t - 1, x.shape
-                )
+                coefs_prev = self.ddpm.step_coefficients[t_index - 1]
+                sqrt_alphas_cumprod_t = coefs_prev["sqrt_alphas_cumprod"]
+                sqrt_one_minus_alphas_cumprod_t = coefs_prev["sqrt_one_minus_alphas_cumprod"]
                 x = (
                     sqrt_alphas_cumprod_t * x_tminus1
                     + sqrt_one_minus_alphas_cumprod_t * noise
@@ -90,13 +122,14 @@ class REpaint:
         return x_tminus1
 
     @torch.no_grad()
-    def p_sample_loop_paint(self, shape):
+    def p_sample_loop_paint(self, shape, keep_every=None, callback=None):
+        """ returns the retained images of the chain, by default only the final sample (see myutils.Trajectory) """
         device = next(self.ddpm.model.parameters()).device
 
         b = shape[0]
         # start from pure noise (for each example in the batch)
         img = torch.randn(shape, device=device)  # this is x_T
-        imgs = []
+        trajectory = myutils.Trajectory(keep_every=keep_every, callback=callback)
 
         # t_T = self.timesteps
         # jump_len = 3
@@ -129,14 +162,17 @@ class REpaint:
                 ),  # an array of size "self.batch_size" containting i
                 t_index=i,
             )
-            imgs.append(img.cpu().numpy())
-        return imgs
+            trajectory.record(i, img, last=(i == 0))
+        return trajectory.imgs
 
     @torch.no_grad()
-    def sample_paint(self):
-        return self.p_sample_loop_paint(
-            shape=(self.ddpm.batch_size, self.ddpm.channels, self.ddpm.image_size, self.ddpm.image_size),
-        )
+    def sample_paint(self, keep_every=None, callback=None):
+        with self.ddpm.select_weights(self.use_ema):
+            return self.p_sample_loop_paint(
+                shape=(self.batch_size, self.ddpm.channels, self.ddpm.image_size, self.ddpm.image_size),
+                keep_every=keep_every,
+                callback=callback,
+            )
 
 
 # schedule with J
@@ -1,10 +1,16 @@
+import os
+import json
+import hashlib
 import datetime
 import numpy as np
 import pickle
 import matplotlib.pyplot as plt
 import click
 import epiframework
+import distributed
 import nn_blocks, idplots, ddpm, myutils, inpaint, ground_truth
+from monitor import TrainingMonitor
+from sample_store import SampleStore
 
 
 import seaborn as sns
@@ -14,7 +20,7 @@ import torch
 import pandas as pd
 import nn_blocks, idplots, ddpm, myutils, inpaint, ground_truth
 
-import data_utils, training_datasets
+import training_datasets
 from torch.utils.data import DataLoader
 from torchvision import transforms
 
@@ -36,8 +42,45 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 
 
 
+def training_ground_truth():
+    """ the ground truth giving the season setup and the scaling of the training datasets """
+    return ground_truth.GroundTruth(season_first_year="2022",
+                                    data_date=datetime.datetime(2022,10,25),
+                                    mask_date=datetime.datetime(2022,10,25),
+                                    channels=channels,
+                                    image_size=image_size,
+                                    nogit=True #so git is not damaged.
+                                )
+
+
+def checkpoint_path(model_folder, epoch):
+    """ checkpoint of a model folder after `epoch` epochs, or "last" for the periodic resume checkpoint """
+    return f"{model_folder}/checkpoint::{epoch}.pth"
+
+
+def truth_hash(gt_date):
+    """ hash of the ground truth a forecast is conditioned on, so a cell is recomputed when the data changes """
+    h = hashlib.sha256()
+    for arr in [gt_date.gt_xarr.data, gt_date.gt_keep_mask]:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()[:16]
+
+
+def save_trained_model(unet, model_folder, transform_inv):
+    """ final checkpoint of a trained spec and a plot of unconditional samples """
+    unet.write_train_checkpoint(save_path=checkpoint_path(model_folder, epoch))
+
+    samples = unet.sample()
+    fig, axes = plt.subplots(8, 7, figsize=(16,16), dpi=100)
+    for ipl in range(51):
+        ax = axes.flat[ipl]
+        for i in range(batch_size):
+            idplots.show_tensor_image(transform_inv(samples[-1][i]), ax = ax, place=ipl, multi=True)
+    plt.savefig(f"{model_folder}/samples::{epoch}.pdf")
+
+
 @click.command()
-@click.option("-s", "--spec_id", "spec_ids", default=-1, help="ID of the model to run")
+@click.option("-s", "--spec_id", "spec_ids", type=str, default="-1", help="ID(s) of the model(s) to run, comma separated (-1: all)")
 @click.option("-t", "--train", "do_training", type=bool, default=False, show_default=True,
             help="Whether to run the inpainting of just train models")
 @click.option("-i", "--inpaint", "do_inpainting", type=bool, default=False, show_default=True,
@@ -46,171 +89,280 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
             show_default=True, help="file prefix to add to identify the current set of runs.")
 @click.option("-d", "--output_directory", "outdir", envvar="OCP_OUTDIR", type=str, default='/work/users/c/h/chadi/influpaint_res/',
             show_default=True, help="Where to write runs")
-def cli(spec_ids, do_training, do_inpainting, file_prefix, outdir):
-    if spec_ids == -1:
+@click.option("-n", "--dates_per_chain", "dates_per_chain", type=int, default=2, show_default=True,
+            help="Number of forecast dates inpainted together in one batched reverse chain, each with batch_size samples (0: all dates at once, needs memory for len(dates) * batch_size frames)")
+@click.option("-p", "--precision", "precision", type=click.Choice(["fp32", "bf16", "fp16"]), default=None,
+            help="Precision of the Unet forward passes for training and sampling (default: fp32 for a new training, else the precision of the checkpoint)")
+@click.option("--channels_last", "channels_last", type=bool, default=False, show_default=True,
+            help="Whether to use the channels_last memory format for the Unet")
+@click.option("-c", "--compile", "compile_mode", type=click.Choice(["none", "compile", "trace"]), default="none", show_default=True,
+            help="Compiled Unet for inpainting: torch.compile, or a torch.jit trace cached on disk (falls back to eager if unavailable)")
+@click.option("-b", "--batched_augmentation", "batched_augmentation", type=bool, default=False, show_default=True,
+            help="Whether to train from a device-resident dataset with batched augmentation instead of a per-item DataLoader")
+@click.option("-e", "--ema_decay", "ema_decay", type=float, default=0, show_default=True,
+            help="Decay of the exponential moving average of the weights tracked during training (0: no EMA)")
+@click.option("--use_ema", "use_ema", type=bool, default=True, show_default=True,
+            help="Whether to inpaint with the EMA weights, when the checkpoint has them")
+@click.option("-g", "--group_training", "group_training", type=bool, default=False, show_default=True,
+            help="Whether to train the selected specs that share a dataset together in this process, each raw batch feeding every model (uses batched augmentation, not with --inpaint)")
+def cli(spec_ids, do_training, do_inpainting, file_prefix, outdir, dates_per_chain, precision, channels_last, compile_mode, batched_augmentation, ema_decay, use_ema, group_training):
+    spec_ids = [int(spec_id) for spec_id in str(spec_ids).split(",")]
+    if spec_ids == [-1]:
             spec_ids = list(np.arange(100))
-    if not isinstance(spec_ids, list):
-        spec_ids = [int(spec_ids)]
-    return spec_ids, do_training, do_inpainting, file_prefix, outdir
+    if group_training and do_training and do_inpainting:
+        # grouped specs are only trained after the selection loop, when their inpainting would already have run
+        raise click.UsageError("--group_training trains after the spec loop: run the inpainting (-i True) in a separate invocation")
+    return spec_ids, do_training, do_inpainting, file_prefix, outdir, dates_per_chain, precision, channels_last, compile_mode, batched_augmentation, ema_decay, use_ema, group_training
 
 if __name__ == '__main__':
     # standalone_mode: so click doesn't exit, see
     # https://stackoverflow.com/questions/60319832/how-to-continue-execution-of-python-script-after-evaluating-a-click-cli-function
-    spec_ids, do_training, do_inpainting, file_prefix, outdir = cli(standalone_mode=False)
-    season_first_year="2022"
-    
+    spec_ids, do_training, do_inpainting, file_prefix, outdir, dates_per_chain, precision, channels_last, compile_mode, batched_augmentation, ema_decay, use_ema, group_training = cli(standalone_mode=False)
+    # launched with torchrun: one process per GPU (or gloo processes on CPU), see distributed.py
+    device = distributed.init_from_env() or device
+    world_size = distributed.get_world_size()
 
-    gt1 = ground_truth.GroundTruth(season_first_year=season_first_year, 
-                                    data_date=datetime.datetime(2022,10,25), 
-                                    mask_date=datetime.datetime(2022,10,25),
-                                    channels=channels,
-                                    image_size=image_size,
-                                    nogit=True #so git is not damaged.
-                                )
-    unet_spec = epiframework.model_libary(image_size=image_size, channels=channels, epoch=epoch, device=device, batch_size=batch_size)
+    gt1 = training_ground_truth()
+    unet_spec = epiframework.model_libary(image_size=image_size, channels=channels, epoch=epoch, device=device, batch_size=batch_size, precision=precision or "fp32", channels_last=channels_last, ema_decay=ema_decay or None)
 
+    # lazy registries: models and datasets are only built when a selected spec needs them, then reused
     dataset_spec = epiframework.dataset_library(gt1=gt1, channels=channels)
-
-    this_spec_id = 0
-
-    for unet_name, unet in unet_spec.items():
-        for dataset_name, dataset in dataset_spec.items():
-            scaling_per_channel = np.array(max(dataset.max_per_feature, gt1.gt_xarr.max(dim=["date", "place"])))
+    dataset_stats_spec = epiframework.dataset_stats_library(gt1=gt1, channels=channels)
+    # only the names are used here, the transforms are built with the scaling of each dataset
+    transform_names, enrich_names = (list(lib) for lib in epiframework.transform_library(scaling_per_channel=np.ones(channels)))
+    scaling_per_dataset = {}
+
+    def dataset_scaling(dataset_name):
+        """ scaling of the transforms of a dataset, part of the hash of its specs """
+        if dataset_name not in scaling_per_dataset:
+            scaling_per_dataset[dataset_name] = epiframework.scaling_per_channel(dataset_stats_spec[dataset_name].max_per_feature, gt1)
+        return scaling_per_dataset[dataset_name]
+
+    # with group_training: dataset name -> members of ddpm.train_group, trained after the selection loop
+    training_groups = {}
+
+    for spec in epiframework.spec_grid(file_prefix, unet_spec, dataset_spec, transform_names, enrich_names, scaling_fn=dataset_scaling):
+        this_spec_id = spec["spec_id"]
+        if this_spec_id in spec_ids:
+            unet_name, dataset_name, transform_name, enrich_name, model_id = (spec[k] for k in ("unet", "dataset", "transform", "enrich", "model_id"))
+            # outputs are stored under the hash of the configuration of the spec, see epiframework.model_folder
+            model_folder = epiframework.model_folder(outdir, spec)
+            scaling_per_channel = dataset_scaling(dataset_name)
             transforms_spec, transform_enrich = epiframework.transform_library(scaling_per_channel=scaling_per_channel)
-            for transform_name, transform in transforms_spec.items():
-                for enrich_name, enrich in transform_enrich.items():
-                    if this_spec_id in spec_ids:
-                        model_id = f"{file_prefix}::model_{unet_name}::dataset_{dataset_name}::trans_{transform_name}::enrich_{enrich_name}"
-                        dataset.add_transform(transform=transform["reg"], transform_inv=transform["inv"], transform_enrich=enrich, bypass_test=False)
-
-                        print(f"id: {this_spec_id} >> doing {model_id}")
-
-                        # *************** TRAINING ***************
-                        if do_training:
-                            model_folder = f"{outdir}{epiframework.get_git_revision_short_hash()}_{datetime.date.today()}"
-                            epiframework.create_folders(model_folder)
-                            
-                            print(f">>> training {model_id}")
-                            print(f">>> saving to {model_folder}")
-
-                            dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True) 
-                            unet.train(dataloader=dataloader)
-                            unet.write_train_checkpoint(save_path=f"{model_folder}/{model_id}::{epoch}.pth")
-
-                            samples = unet.sample()
-                            fig, axes = plt.subplots(8, 7, figsize=(16,16), dpi=100)
-                            for ipl in range(51):
-                                ax = axes.flat[ipl]
-                                for i in range(batch_size):
-                                    idplots.show_tensor_image(dataset.apply_transform_inv(samples[-1][i]), ax = ax, place=ipl, multi=True)
-                            plt.savefig(f"{model_folder}/{model_id}-{epoch}::samples.pdf")
+            transform, enrich = transforms_spec[transform_name], transform_enrich[enrich_name]
+
+            print(f"id: {this_spec_id} >> doing {model_id} in {model_folder}")
+
+            # *************** TRAINING ***************
+            if do_training and os.path.exists(checkpoint_path(model_folder, epoch)):
+                print(f">>> {model_id} is already trained, see {checkpoint_path(model_folder, epoch)}")
+            elif do_training:
+                if distributed.is_main_process():
+                    epiframework.write_spec_manifest(model_folder, spec, training={"precision": precision or "fp32", "ema_decay": ema_decay or None,
+                                                                                   "channels_last": channels_last})
+                distributed.barrier()
+
+                # periodic checkpoint of the full training state, to resume if the job is preempted
+                resume_fn = checkpoint_path(model_folder, "last")
+                # a new model for each spec, several specs may be trained by this process
+                unet = unet_spec.build(unet_name)
+                if os.path.exists(resume_fn):
+                    unet.load_model_checkpoint(resume_fn, use_checkpoint_precision=precision is None)
+
+                if group_training:
+                    print(f">>> {model_id} will be trained with the other specs on dataset {dataset_name}")
+                    batch_transforms_spec, batch_transform_enrich = epiframework.batch_transform_library(scaling_per_channel=scaling_per_channel)
+                    batch_transform, batch_enrich = batch_transforms_spec[transform_name], batch_transform_enrich[enrich_name]
+                    training_groups.setdefault(dataset_name, []).append({
+                        "ddpm": unet,
+                        "transform": lambda raw, batch_transform=batch_transform, batch_enrich=batch_enrich: batch_transform(batch_enrich(raw)),
+                        "checkpoint_path": resume_fn,
+                        "checkpoint_every_epochs": 50,
+                        "checkpoint_every_minutes": 30,
+                        "monitor": TrainingMonitor(f"{model_folder}/monitor"),
+                        "model_folder": model_folder,
+                        "model_id": model_id,
+                        "transform_inv": transform["inv"],
+                    })
+                else:
+                    print(f">>> training {model_id}")
+                    dataset = dataset_spec[dataset_name]
+                    dataset.add_transform(transform=transform["reg"], transform_inv=transform["inv"], transform_enrich=enrich, bypass_test=False)
+                    print(f">>> saving to {model_folder}")
+
+                    if batched_augmentation:
+                        batch_transforms_spec, batch_transform_enrich = epiframework.batch_transform_library(scaling_per_channel=scaling_per_channel)
+                        dataloader = training_datasets.BatchedFluLoader(dataset, batch_size=batch_size // world_size, device=device,
+                                                                        transform=batch_transforms_spec[transform_name],
+                                                                        transform_enrich=batch_transform_enrich[enrich_name],
+                                                                        rank=distributed.get_rank(), world_size=world_size)
+                    elif world_size > 1:
+                        dataloader = distributed.distributed_dataloader(dataset, batch_size=batch_size)
+                    else:
+                        if isinstance(dataset, training_datasets.CompositeFluDataset):
+                            dataloader = DataLoader(dataset, batch_size=batch_size, sampler=dataset.sampler(), drop_last=True)
+                        else:
+                            dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+                    unet.train(dataloader=dataloader, checkpoint_path=resume_fn, checkpoint_every_epochs=50, checkpoint_every_minutes=30,
+                               monitor=TrainingMonitor(f"{model_folder}/monitor"))
+                    if distributed.is_main_process():
+                        save_trained_model(unet, model_folder, transform_inv=dataset.apply_transform_inv)
+            
+            # *************** INPAINTING ***************
+            if do_inpainting:
+                checkpoint_fn = checkpoint_path(model_folder, epoch)
+                if not os.path.exists(checkpoint_fn):
+                    print(f"EE no trained checkpoint {checkpoint_fn} for {model_id}, skipping its inpainting")
+                    continue
+
+                ddpm1 = unet_spec[unet_name]
+                # inpainting only needs the scaling statistics of the dataset, not its frames
+                dataset = dataset_stats_spec[dataset_name]
+                dataset.add_transform(transform=transform["reg"], transform_inv=transform["inv"], transform_enrich=enrich, bypass_test=True)
+                
+                # the precision and the EMA weights the model was trained with, unless -p is given
+                ddpm1.load_model_checkpoint(checkpoint_fn, use_checkpoint_precision=precision is None)
+                # selects the weights for model_fn, thus for the compiled Unet and CoPaint too
+                ddpm1.use_ema = use_ema
+                compiled_batch = None
+                # raw ensembles, to re-score or re-plot without re-running the diffusion
+                sample_store = SampleStore(f"{outdir}samples")
+
+                #fdates = pd.date_range("2022-11-14", "2023-05-15", freq="5W-MON")
+                #fdates = pd.DatetimeIndex(['2022-11-07','2022-11-14','2022-12-12','2023-01-09','2023-03-06'])
+                fdates = pd.date_range("2022-10-12", "2023-05-15", freq="2W-MON")
+                gts_date = [ground_truth.GroundTruth(season_first_year="2022", 
+                                                data_date=datetime.datetime.today(), 
+                                                mask_date=date,
+                                                channels=channels,
+                                                image_size=image_size,
+                                                nogit=True
+                                                ) for date in fdates]
+
+                # each (CoPaint config, forecast date) cell is stored under the hash of its inputs: the model,
+                # the config, the weights and number of samples, and the ground truth it is conditioned on.
+                # Only the cells that are missing or whose inputs changed are computed.
+                copaint_confs = {conf_name: conf for conf_name, conf in epiframework.copaint_config_library(ddpm1.timesteps).items() if "TT" in conf_name}
+                copaint_dicts = epiframework.copaint_config_dicts(ddpm1.timesteps)
+                inpaint_folders = {}
+                for conf_name in copaint_confs:
+                    inpaint_config = {"model_hash": spec["model_hash"], "method": "CoPaint", "conf_name": conf_name, "conf": copaint_dicts[conf_name],
+                                      "ema": ddpm1.ema_selected(), "samples_per_date": batch_size}
+                    inpaint_folders[conf_name] = f"{model_folder}/forecasts/{epiframework.config_hash(inpaint_config)}"
+                    epiframework.create_folders(f"{inpaint_folders[conf_name]}/cells")
+                    with open(f"{inpaint_folders[conf_name]}/inpaint.json", "w") as f:
+                        json.dump({"model_id": model_id, **inpaint_config}, f, indent=1)
+                cells = [{"forecast_date": str(date.date()), "truth": truth_hash(gt_date)} for date, gt_date in zip(fdates, gts_date)]
+
+                def cell_fn(conf_name, i):
+                    return f"{inpaint_folders[conf_name]}/cells/{cells[i]['forecast_date']}.json"
+
+                def cell_done(conf_name, i):
+                    if not os.path.exists(cell_fn(conf_name, i)):
+                        return False
+                    with open(cell_fn(conf_name, i)) as f:
+                        return json.load(f) == cells[i]
+
+                todo = {conf_name: [i for i in range(len(fdates)) if not cell_done(conf_name, i)] for conf_name in copaint_confs}
+                for conf_name, dates_idx in todo.items():
+                    print(f">>> CoPaint {conf_name}: {len(fdates) - len(dates_idx)} of {len(fdates)} forecast dates up to date in {inpaint_folders[conf_name]}")
+
+                # chunks of dates_per_chain forecast dates (or all of them with 0) share one batched reverse chain,
+                # with batch_size samples per date.
+                plot_jobs = []
+                for conf_name, conf in copaint_confs.items():
+                    dates_idx = todo[conf_name]
+                    chunk_len = dates_per_chain if dates_per_chain > 0 else max(len(dates_idx), 1)
+                    for chunk_start in range(0, len(dates_idx), chunk_len):
+                        chunk_idx = dates_idx[chunk_start:chunk_start+chunk_len]
+                        dates_chunk = fdates[chunk_idx]
+                        gts_chunk = [gts_date[i] for i in chunk_idx]
+
+                        gt = np.stack([dataset.apply_transform(gt_date.gt_xarr.data) for gt_date in gts_chunk]) # data.apply_transform
+                        gt_keep_mask = np.stack([gt_date.gt_keep_mask for gt_date in gts_chunk])
+                        gt_keep_mask = torch.from_numpy(gt_keep_mask).type(torch.FloatTensor).to(device)
+                        gt = torch.from_numpy(gt).type(torch.FloatTensor).to(device)
+                        gt_batch, gt_keep_mask_batch = inpaint.batch_gt(gt, gt_keep_mask, samples_per_gt=batch_size)
+                        if compile_mode != "none" and compiled_batch != gt_batch.shape[0]:
+                            ddpm1.compile_inference(mode=compile_mode, batch_size=gt_batch.shape[0], cache_dir=f"{model_folder}/compiled_models")
+                            compiled_batch = gt_batch.shape[0]
+
+                        # # ****************** REPaint ******************
+                        # for resampling_steps in [1, 10]:
+                        #     inpaint1 = inpaint.REpaint(ddpm=ddpm1, gt=gt, gt_keep_mask=gt_keep_mask, resampling_steps=resampling_steps, samples_per_gt=batch_size)
+                        # 
+                        #     samples = inpaint1.sample_paint()
+                        #     fluforecasts_per_date = inpaint.split_per_gt(samples[-1], n_gt=len(dates_chunk))
+                        #     for gt_date, date, fluforecasts in zip(gts_chunk, dates_chunk, fluforecasts_per_date):
+                        #         fluforecasts_ti = dataset.apply_transform_inv(fluforecasts)
+                        #         # compute the national quantiles, important as sum of quantiles >> quantiles of sum
+                        #         forecasts_national = fluforecasts_ti.sum(axis=-1)
+
+                        #         forecast_fn = f"{model_id}::inpaint_Repaint::resamp_{resampling_steps}"
+                        #         inpaint_folder = f"{model_folder}/forecasts/{forecast_fn}"
+                        #         epiframework.create_folders(inpaint_folder)
+
+                        #         gt_date.export_forecasts(fluforecasts_ti=fluforecasts_ti,
+                        #                             forecasts_national=forecasts_national,
+                        #                             directory=inpaint_folder,
+                        #                             prefix=forecast_fn,
+                        #                             forecast_date=date.date(),
+                        #                             save_plot=True,
+                        #                             nochecks=True)
+
+                        # ****************** CoPaint ******************
+                        sampler = O_DDIMSampler(use_timesteps=np.arange(ddpm1.timesteps), 
+                                            conf=conf,
+                                            betas=ddpm1.betas.cpu(), 
+                                            model_mean_type=None,
+                                            model_var_type=None,
+                                            loss_type=None)
                         
-                        # *************** INPAINTING ***************
-                        if do_inpainting:
-                            model_folder = f"/work/users/c/h/chadi/influpaint_res/3d47f4a_2023-11-07"
-                            checkpoint_fn = f"{model_folder}/{model_id}::{epoch}.pth"
-
-                            model_str = checkpoint_fn.split('/')[-1]
-                            # THIS is already done
-                            for part in model_str.split('::')[1:-1]:
-                                tp, val = part.split('_')
-                                if tp == 'model':
-                                    unet_spec = epiframework.model_libary(image_size=image_size, channels=channels, epoch=epoch, device=device, batch_size=batch_size)
-                                    ddpm1 = unet_spec[val]
-                                elif tp == "dataset":
-                                    dataset_spec = epiframework.dataset_library(gt1=gt1, channels=channels)
-                                    dataset = dataset_spec[val]
-                                elif tp == "trans":
-                                    scaling_per_channel = np.array(max(dataset.max_per_feature, gt1.gt_xarr.max(dim=["date", "place"])))
-                                    transforms_spec, transform_enrich = epiframework.transform_library(scaling_per_channel=scaling_per_channel)
-                                    transform = transforms_spec[val]
-                                elif tp == "enrich":
-                                    scaling_per_channel = np.array(max(dataset.max_per_feature, gt1.gt_xarr.max(dim=["date", "place"])))
-                                    transforms_spec, transform_enrich = epiframework.transform_library(scaling_per_channel=scaling_per_channel)
-                                    enrich = transform_enrich[val]
-                            dataset.add_transform(transform=transform["reg"], transform_inv=transform["inv"], transform_enrich=enrich, bypass_test=False)
-                            
-                            ddpm1.load_model_checkpoint(checkpoint_fn)
-
-                            #fdates = pd.date_range("2022-11-14", "2023-05-15", freq="5W-MON")
-                            #fdates = pd.DatetimeIndex(['2022-11-07','2022-11-14','2022-12-12','2023-01-09','2023-03-06'])
-                            fdates = pd.date_range("2022-10-12", "2023-05-15", freq="2W-MON")
-                            for date in fdates:
-                                gt1 = ground_truth.GroundTruth(season_first_year="2022", 
-                                                            data_date=datetime.datetime.today(), 
-                                                            mask_date=date,
-                                                            channels=channels,
-                                                            image_size=image_size,
-                                                            nogit=True
-                                                            )
-
-                                gt = dataset.apply_transform(gt1.gt_xarr.data) # data.apply_transform
-                                gt_keep_mask = torch.from_numpy(gt1.gt_keep_mask).type(torch.FloatTensor).to(device)
-                                gt = torch.from_numpy(gt).type(torch.FloatTensor).to(device)
-
-                                # # ****************** REPaint ******************
-                                # for resampling_steps in [1, 10]:
-                                #     inpaint1 = inpaint.REpaint(ddpm=ddpm1, gt=gt, gt_keep_mask=gt_keep_mask, resampling_steps=resampling_steps)
-                                # 
-                                #     n_samples = batch_size
-                                #     all_samples = []
-                                #     for i in range(max(n_samples//batch_size,1)):
-                                #         samples = inpaint1.sample_paint()
-                                #         all_samples.append(samples)
-                                #     fluforecasts = -1*np.ones((batch_size*max(n_samples//batch_size,1), 1, 64, 64))
-                                #     for i in range(max(n_samples//batch_size,1)):
-                                #         fluforecasts[i*batch_size:i*batch_size+batch_size] = all_samples[i][-1]
-                                #     
-                                #     fluforecasts_ti = dataset.apply_transform_inv(fluforecasts)
-                                #     # compute the national quantiles, important as sum of quantiles >> quantiles of sum
-                                #     forecasts_national = fluforecasts_ti.sum(axis=-1)
-
-                                #     forecast_fn = f"{model_str.split('.')[0]}::inpaint_Repaint::resamp_{resampling_steps}"
-                                #     inpaint_folder = f"{model_folder}/forecasts/{forecast_fn}"
-                                #     epiframework.create_folders(inpaint_folder)
-
-                                #     gt1.export_forecasts(fluforecasts_ti=fluforecasts_ti,
-                                #                         forecasts_national=forecasts_national,
-                                #                         directory=inpaint_folder,
-                                #                         prefix=forecast_fn,
-                                #                         forecast_date=date.date(),
-                                #                         save_plot=True,
-                                #                         nochecks=True)
-
-                                # ****************** CoPaint ******************
-                                for conf_name, conf in epiframework.copaint_config_library(ddpm1.timesteps).items():
-                                    if "TT" in conf_name:
-                                        sampler = O_DDIMSampler(use_timesteps=np.arange(ddpm1.timesteps), 
-                                                            conf=conf,
-                                                            betas=ddpm1.betas, 
-                                                            model_mean_type=None,
-                                                            model_var_type=None,
-                                                            loss_type=None)
-                                        
-                                        a = sampler.p_sample_loop(model_fn=ddpm1.model, 
-                                                                shape=(batch_size, channels, image_size, image_size),
-                                                                conf=conf,
-                                                                model_kwargs={"gt": gt.repeat(batch_size, 1, 1, 1),
-                                                                                "gt_keep_mask":gt_keep_mask.repeat(batch_size, 1, 1, 1),
-                                                                                "mymodel":True, 
-                                                                            }
-                                                                )
-                                        fluforecasts = np.array(a['sample'].cpu())
-
-                                        fluforecasts_ti = dataset.apply_transform_inv(fluforecasts)
-                                        # compute the national quantiles, important as sum of quantiles >> quantiles of sum
-                                        forecasts_national = fluforecasts_ti.sum(axis=-1)
-
-                                        forecast_fn = f"{model_str.split('.')[0]}::inpaint_CoPaint::conf_{conf_name}"
-                                        inpaint_folder = f"{model_folder}/forecasts_noTT/{forecast_fn}"
-                                        epiframework.create_folders(inpaint_folder)
-
-                                        gt1.export_forecasts(fluforecasts_ti=fluforecasts_ti,
-                                                            forecasts_national=forecasts_national,
-                                                            directory=inpaint_folder,
-                                                            prefix=forecast_fn,
-                                                            forecast_date=date.date(),
-                                                            save_plot=True,
-                                                            nochecks=True)
-
-                    this_spec_id += 1
+                        a = sampler.p_sample_loop(model_fn=ddpm1.model_fn, 
+                                                shape=(gt_batch.shape[0], channels, image_size, image_size),
+                                                conf=conf,
+                                                model_kwargs={"gt": gt_batch,
+                                                                "gt_keep_mask":gt_keep_mask_batch,
+                                                                "mymodel":True, 
+                                                            }
+                                                )
+                        fluforecasts_per_date = inpaint.split_per_gt(np.array(a['sample'].cpu()), n_gt=len(dates_chunk))
+
+                        for i, gt_date, date, fluforecasts in zip(chunk_idx, gts_chunk, dates_chunk, fluforecasts_per_date):
+                            fluforecasts_ti = dataset.apply_transform_inv(fluforecasts)
+                            # compute the national quantiles, important as sum of quantiles >> quantiles of sum
+                            forecasts_national = fluforecasts_ti.sum(axis=-1)
+
+                            forecast_fn = f"{model_id}::inpaint_CoPaint::conf_{conf_name}"
+                            inpaint_folder = inpaint_folders[conf_name]
+
+                            sample_store.write(model_id=spec["model_hash"], inpaint_config=os.path.basename(inpaint_folder), forecast_date=date.date(),
+                                                fluforecasts_ti=fluforecasts_ti, forecasts_national=forecasts_national,
+                                                n_places=len(gt_date.flusetup.locations), first_week_idx=gt_date.inpaintfrom_idx)
+
+                            plot_job = gt_date.export_forecasts(fluforecasts_ti=fluforecasts_ti,
+                                                forecasts_national=forecasts_national,
+                                                directory=inpaint_folder,
+                                                prefix=forecast_fn,
+                                                forecast_date=date.date(),
+                                                save_plot=True,
+                                                nochecks=True,
+                                                defer_plot=True)
+                            plot_jobs.append(plot_job)
+                            # the cell is done once its forecasts are written
+                            with open(cell_fn(conf_name, i), "w") as f:
+                                json.dump(cells[i], f)
+
+                # csv are all written, now render the pdfs in parallel
+                ground_truth.render_forecast_plots(plot_jobs)
+
+    # *************** GROUP TRAINING ***************
+    # the dataset of each group is loaded once, each raw batch is augmented and fed to every model of the group
+    for dataset_name, members in training_groups.items():
+        print(f">>> training {len(members)} specs together on dataset {dataset_name}: {[member['model_id'] for member in members]}")
+        dataloader = training_datasets.BatchedFluLoader(dataset_spec[dataset_name], batch_size=batch_size // world_size, device=device,
+                                                        rank=distributed.get_rank(), world_size=world_size)
+        ddpm.train_group(members, dataloader)
+        if distributed.is_main_process():
+            for member in members:
+                save_trained_model(member["ddpm"], member["model_folder"], transform_inv=member["transform_inv"])
@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+
+class TrainingMonitor:
+    """
+    Monitor a DDPM training off the critical path: the training loop only pushes the step losses and,
+    at the end of each epoch, possibly a CPU copy of the model. A background thread writes to `folder`:
+    - `losses.csv`: epoch, step, loss and wall time of each optimizer step
+    - `throughput.csv`: steps/s and samples/s over each reporting interval
+    - `loss.png`: the loss curves (full, last 1000 and last 100 steps)
+    - `preview-epoch<N>.png`: a few samples from a short respaced chain run on CPU
+    Nothing is drawn with pyplot, so no window is ever opened on a batch node.
+    """
+    def __init__(self, folder, report_every_seconds=60, preview_every_epochs=50, preview_n=4, preview_steps=10):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.report_every_seconds = report_every_seconds
+        self.preview_every_epochs = preview_every_epochs
+        self.preview_n = preview_n
+        self.preview_steps = preview_steps
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.records = []
+        self.last_report = None
+
+    def start(self):
+        if self.thread is None:
+            self.last_report = time.monotonic()
+            self.thread = threading.Thread(target=self._run, name="training-monitor", daemon=True)
+            self.thread.start()
+        return self
+
+    def log_step(self, epoch, step, loss, n_samples):
+        self.queue.put(("step", (epoch, step, loss, n_samples, time.monotonic())))
+
+    def log_epoch(self, ddpm, epoch):
+        """ called at the end of each epoch, queue a preview every `preview_every_epochs` epochs """
+        if self.preview_every_epochs and epoch > 0 and epoch % self.preview_every_epochs == 0:
+            self.queue.put(("preview", (ddpm.preview_copy(), epoch)))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(("close", None))
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            try:
+                kind, payload = self.queue.get(timeout=1)
+            except queue.Empty:
+                kind, payload = None, None
+            try:
+                if kind == "step":
+                    self.records.append(payload)
+                elif kind == "preview":
+                    self.write_preview(*payload)
+                if kind == "close" or time.monotonic() - self.last_report > self.report_every_seconds:
+                    self.write_report()
+            except Exception as e:  # never let monitoring kill the training
+                print(f" !! training monitor: {type(e).__name__}: {e}")
+            if kind == "close":
+                return
+
+    def write_report(self):
+        now = time.monotonic()
+        new_records = [r for r in self.records if r[4] > self.last_report]
+        if new_records:
+            elapsed = now - self.last_report
+            throughput = pd.DataFrame([{
+                "epoch": new_records[-1][0],
+                "steps": len(new_records),
+                "steps_per_s": len(new_records) / elapsed,
+                "samples_per_s": sum(r[3] for r in new_records) / elapsed,
+            }])
+            throughput_fn = self.folder / "throughput.csv"
+            throughput.to_csv(throughput_fn, mode="a", header=not throughput_fn.exists(), index=False)
+        self.last_report = now
+
+        if not self.records:
+            return
+        df = pd.DataFrame(self.records, columns=["epoch", "step", "loss", "n_samples", "time"])
+        df.to_csv(self.folder / "losses.csv", index=False)
+
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(9, 3), dpi=100)
+        axes = fig.subplots(1, 3)
+        losses = df["loss"].to_numpy()
+        for ax, n_last, title in zip(axes, [len(losses), 1000, 100], ["all", "last 1000", "last 100"]):
+            ax.plot(np.arange(len(losses))[-n_last:], losses[-n_last:], lw=.5)
+            ax.set_title(title, fontsize=8)
+        fig.tight_layout()
+        fig.savefig(self.folder / "loss.png")
+
+    def write_preview(self, preview_ddpm, epoch):
+        with torch.no_grad():
+            samples = preview_ddpm.ddim_sample_loop(
+                (self.preview_n, preview_ddpm.channels, preview_ddpm.image_size, preview_ddpm.image_size),
+                sampling_steps=min(self.preview_steps, preview_ddpm.timesteps),
+                eta=1.0,
+            )[-1]
+
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(3 * self.preview_n, 3), dpi=100)
+        axes = fig.subplots(1, self.preview_n, squeeze=False)[0]
+        for ax, sample in zip(axes, samples):
+            ax.imshow(sample[0], cmap="Greys")
+            ax.set_axis_off()
+        fig.suptitle(f"epoch {epoch}, {self.preview_steps} steps", fontsize=8)
+        fig.savefig(self.folder / f"preview-epoch{epoch}.png")
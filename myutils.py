@@ -14,7 +14,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-import data_utils, training_datasets
+import training_datasets
 from torch.utils.data import DataLoader
 from torchvision import transforms
 import datetime
@@ -40,12 +40,133 @@ def get_folders_in_directory(directory_path):
 def extract(a, t, x_shape):
     """
     define an `extract` function, which will allow us to extract the appropriate \\(t\\) index for a batch of indices.
+    The gather happens on the device of `a` (the schedule tensors of DDPM live next to the model), so there
+    is no host round-trip when `a` and `t` share a device.
     """
     batch_size = t.shape[0]
-    out = a.gather(-1, t.cpu())
+    out = a.gather(-1, t.to(a.device))
     return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
 
 
+def crps_ensemble(samples, obs):
+    """
+    Continuous Ranked Probability Score of an ensemble `samples` (n_samples, ...) against
+    observations `obs` (...), computed pointwise with the sorted-ensemble formula
+    CRPS = E|X - y| - 1/2 E|X - X'|, which is O(n log n) instead of O(n^2).
+    """
+    samples = np.sort(np.asarray(samples), axis=0)
+    n = samples.shape[0]
+    abs_error = np.mean(np.abs(samples - obs), axis=0)
+    weights = (2 * np.arange(1, n + 1) - n - 1).reshape(n, *((1,) * (samples.ndim - 1)))
+    spread = np.sum(weights * samples, axis=0) / n ** 2
+    return abs_error - spread
+
+
+class Trajectory:
+    """
+    Collect the images of a reverse diffusion chain. By default only the final sample is copied to
+    host memory, `keep_every=k` also keeps every k-th step. With `callback(step, img)`, the kept steps
+    are given to the callback (on-device tensor, e.g `memmap_callback` to stream them to disk) instead
+    of being kept; the final sample is always kept too, so `imgs[-1]` is the sample.
+    """
+    def __init__(self, keep_every=None, callback=None):
+        self.keep_every = keep_every
+        self.callback = callback
+        self.imgs = []
+
+    def record(self, step, img, last=False):
+        if not last and (self.keep_every is None or step % self.keep_every != 0):
+            return
+        if self.callback is not None:
+            self.callback(step, img)
+        if self.callback is None or last:
+            self.imgs.append(img.cpu().numpy())
+
+
+def memmap_callback(filename, n_steps, shape):
+    """
+    Trajectory callback writing each recorded step in a float32 memmap of shape (n_steps, *shape).
+    Steps are stored in the order they are recorded.
+    """
+    mm = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=(n_steps, *shape))
+    position = {"next": 0}
+
+    def callback(step, img):
+        mm[position["next"]] = img.cpu().numpy()
+        position["next"] += 1
+        mm.flush()
+
+    return callback
+
+
+def unwrap_state_dict(state_dict):
+    """ state dict without the `module.` prefix of the keys of nn.DataParallel/DistributedDataParallel models """
+    return {(k[len("module."):] if k.startswith("module.") else k): v for k, v in state_dict.items()}
+
+
+def state_to_cpu(obj):
+    """ recursively copy the tensors of a (state) dict/list to CPU, so it can be saved while training continues """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: state_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(state_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    import random
+    # numpy keys as a tensor so that the checkpoint only holds tensors and python builtins
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = np.random.get_state()
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": (np_name, torch.from_numpy(np_keys.astype(np.int64)), np_pos, np_has_gauss, np_cached_gaussian),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    import random
+    random.setstate(rng_state["python"])
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = rng_state["numpy"]
+    np.random.set_state((np_name, np.asarray(np_keys).astype(np.uint32), np_pos, np_has_gauss, np_cached_gaussian))
+    torch.set_rng_state(rng_state["torch"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+def atomic_torch_save(obj, save_path):
+    """ torch.save to a temporary file then rename, so a preempted job never leaves a truncated checkpoint """
+    import os
+    tmp_path = f"{save_path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, save_path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints with atomic_torch_save in a background thread. At most one write is in flight:
+    submitting while the previous one is still being written waits for it first.
+    """
+    def __init__(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def submit(self, obj, save_path):
+        self.wait()
+        self.future = self.executor.submit(atomic_torch_save, obj, save_path)
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()  # re-raises errors of the write
+            self.future = None
+
+
 def cuda_mem_info():
     # print(torch.cuda.memory_summary(device=None, abbreviated=False)) is the long form
     convert_to_gb = 1024 ** 3
@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+
+class SampleStore:
+    """
+    Persistent store of the raw inpainting ensembles, so forecasts can be re-scored, re-aggregated or
+    re-plotted without re-running the diffusion. Each forecast is a compressed, chunked NetCDF file
+    at `root/<model_id>/<inpaint_config>/<forecast_date>.nc` holding, as float32:
+    - `states` (sample, date, place): the inverse transformed samples of the real places only
+    - `national` (sample, date): the national sum, as computed for the export
+    restricted to the inpainted weeks (from `first_week_idx` to the end of the 64-week frame). Files are
+    opened lazily: only the slices that are used are read from disk.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, model_id, inpaint_config, forecast_date):
+        return self.root / str(model_id) / str(inpaint_config) / f"{forecast_date}.nc"
+
+    def exists(self, model_id, inpaint_config, forecast_date):
+        return self.path(model_id, inpaint_config, forecast_date).exists()
+
+    def write(self, model_id, inpaint_config, forecast_date, fluforecasts_ti, forecasts_national, n_places, first_week_idx=0, n_weeks=None):
+        """
+        fluforecasts_ti (n_samples, channels, 64, 64) and forecasts_national (n_samples, channels, 64) as given to
+        GroundTruth.export_forecasts. Only channel 0, the `n_places` real places and the weeks
+        `first_week_idx:first_week_idx+n_weeks` (default: to the end) are kept.
+        """
+        weeks = slice(first_week_idx, None if n_weeks is None else first_week_idx + n_weeks)
+        states = np.asarray(fluforecasts_ti[:, 0, weeks, :n_places], dtype=np.float32)
+        national = np.asarray(forecasts_national[:, 0, weeks], dtype=np.float32)
+        n_samples, n_dates, _ = states.shape
+
+        ds = xr.Dataset(
+            {
+                "states": (("sample", "date", "place"), states),
+                "national": (("sample", "date"), national),
+            },
+            coords={"date": np.arange(first_week_idx, first_week_idx + n_dates)},
+            attrs={"model_id": str(model_id), "inpaint_config": str(inpaint_config), "forecast_date": str(forecast_date)},
+        )
+        encoding = {
+            "states": {"zlib": True, "complevel": 4, "chunksizes": (min(n_samples, 128), n_dates, n_places)},
+            "national": {"zlib": True, "complevel": 4, "chunksizes": (min(n_samples, 128), n_dates)},
+        }
+        fn = self.path(model_id, inpaint_config, forecast_date)
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fn = fn.with_suffix(".nc.tmp")
+        ds.to_netcdf(tmp_fn, encoding=encoding)
+        tmp_fn.replace(fn)
+        return fn
+
+    def open(self, model_id, inpaint_config, forecast_date):
+        """ lazily opened xr.Dataset, slice it (e.g `.isel(date=...)`) before loading """
+        return xr.open_dataset(self.path(model_id, inpaint_config, forecast_date))
+
+    def read_forecasts(self, model_id, inpaint_config, forecast_date, date_idx=None, frame_size=64):
+        """
+        Arrays shaped like the in-memory forecasts of GroundTruth.export_forecasts/plot_forecasts,
+        (n_samples, 1, frame_size, n_places) and (n_samples, 1, frame_size), NaN where nothing is stored.
+        If `date_idx` (week indices in the frame) is given, only these weeks are read from disk.
+        """
+        with self.open(model_id, inpaint_config, forecast_date) as ds:
+            if date_idx is not None:
+                ds = ds.sel(date=[d for d in np.atleast_1d(date_idx) if d in ds["date"].values])
+            dates = ds["date"].values
+            states = ds["states"].values
+            national = ds["national"].values
+
+        fluforecasts_ti = np.full((states.shape[0], 1, frame_size, states.shape[2]), np.nan, dtype=np.float32)
+        forecasts_national = np.full((states.shape[0], 1, frame_size), np.nan, dtype=np.float32)
+        fluforecasts_ti[:, 0, dates] = states
+        forecasts_national[:, 0, dates] = national
+        return fluforecasts_ti, forecasts_national
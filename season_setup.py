@@ -1,4 +1,5 @@
 import datetime
+import numpy as np
 import pandas as pd
 
 # locations, in the right order
@@ -23,6 +24,7 @@ class SeasonSetup:
             (because 2022-2023 contains virgin islands, 2023-2024 does not)
     - get_fluseason_year(ts): Returns the flu season year for a given timestamp.
     - get_fluseason_fraction(ts): Returns the fraction of the flu season for a given timestamp.
+    - get_fluseason_year_fraction(dates): Vectorized flu season years and fractions of many dates.
     """
 
     def __init__(
@@ -94,6 +96,9 @@ class SeasonSetup:
     def get_fluseason_fraction(self, ts):
         return get_season_fraction(ts, self.fluseason_startdate)
     
+    def get_fluseason_year_fraction(self, dates):
+        return get_season_year_fraction(dates, self.fluseason_startdate)
+
     def get_location_name(self, location_code):
         if pd.isna(location_code):
             return "NA"
@@ -126,3 +131,14 @@ def get_season_fraction(ts, start_date):
         return ((ts.dayofyear + 365) - start_date.dayofyear) / 365
 
 
+def get_season_year_fraction(dates, start_date):
+    """
+    Vectorized get_season_year and get_season_fraction over a column of dates: returns the arrays
+    (years, fractions), NaN where the date is NaT.
+    """
+    dates = pd.DatetimeIndex(dates)
+    dayofyear = np.asarray(dates.dayofyear, dtype=float)
+    in_start_year = dayofyear >= start_date.dayofyear
+    years = np.where(in_start_year, dates.year, dates.year - 1)
+    fractions = (np.where(in_start_year, dayofyear, dayofyear + 365) - start_date.dayofyear) / 365
+    return years, fractions
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import datetime
+import threading
+import subprocess
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import click
+
+import epiframework
+import main
+
+
+spec_labels = ["spec_id", "unet", "dataset", "transform", "enrich", "model_id"]
+
+
+def enumerate_specs(file_prefix):
+    """
+    the spec grid of main.py, with the model hashes main.py computes (the options of main.py, e.g the
+    precision, are not hashed). Only the cached dataset statistics are read, nothing is built.
+    """
+    gt1 = main.training_ground_truth()
+    unet_spec = epiframework.model_libary(image_size=main.image_size, channels=main.channels, epoch=main.epoch, device="cpu",
+                                          batch_size=main.batch_size)
+    dataset_spec = epiframework.dataset_library(gt1=gt1, channels=main.channels)
+    dataset_stats_spec = epiframework.dataset_stats_library(gt1=gt1, channels=main.channels)
+    transform_names, enrich_names = (list(lib) for lib in epiframework.transform_library(scaling_per_channel=np.ones(main.channels)))
+    return epiframework.spec_grid(file_prefix, unet_spec, dataset_spec, transform_names, enrich_names,
+                                  scaling_fn=lambda name: epiframework.scaling_per_channel(dataset_stats_spec[name].max_per_feature, gt1))
+
+
+def load_manifest(sweep_dir, file_prefix, outdir):
+    """
+    The spec grid, persisted once to `sweep_dir/manifest.json` so that spec ids keep their meaning for
+    the whole sweep. Raises if the names of the grid changed since the manifest was written; the model
+    hashes are updated when the configurations changed (e.g a new version of a source file or of the transforms).
+    """
+    manifest_fn = os.path.join(sweep_dir, "manifest.json")
+    specs = enumerate_specs(file_prefix)
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+        if [[spec[k] for k in spec_labels] for spec in manifest["specs"]] != [[spec[k] for k in spec_labels] for spec in specs]:
+            raise ValueError(f"the spec grid changed since {manifest_fn} was written, use a new sweep directory")
+        if [spec["model_hash"] for spec in manifest["specs"]] == [spec["model_hash"] for spec in specs]:
+            return manifest
+        print(f">> the configuration of some specs changed, updating the model hashes of {manifest_fn}")
+    else:
+        manifest = {"file_prefix": file_prefix, "outdir": outdir, "created": datetime.datetime.now().isoformat()}
+    manifest["specs"] = specs
+    os.makedirs(sweep_dir, exist_ok=True)
+    with open(f"{manifest_fn}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+    os.replace(f"{manifest_fn}.tmp", manifest_fn)
+    print(f">> wrote the manifest of {len(specs)} specs to {manifest_fn}")
+    return manifest
+
+
+def job_done(job, sweep_dir):
+    """
+    a training is done if the final checkpoint of its model hash exists, an inpainting if the runner
+    recorded its success for this model hash (main.py itself skips the forecast cells that are up to date)
+    """
+    if job["stage"] == "train":
+        return os.path.exists(main.checkpoint_path(job["model_folder"], main.epoch))
+    return os.path.exists(os.path.join(sweep_dir, "done", job["job_id"]))
+
+
+def make_jobs(manifest, stages, spec_ids=None, main_args=""):
+    jobs = []
+    for stage in stages:
+        for spec in manifest["specs"]:
+            if spec_ids is not None and spec["spec_id"] not in spec_ids:
+                continue
+            stage_flag = ["--train", "True"] if stage == "train" else ["--inpaint", "True"]
+            jobs.append({
+                "job_id": f"{stage}-{spec['spec_id']}-{spec['model_hash']}",
+                "stage": stage,
+                "spec_id": spec["spec_id"],
+                "model_id": spec["model_id"],
+                "model_folder": epiframework.model_folder(manifest["outdir"], spec),
+                "command": [sys.executable, "-u", "main.py", "--spec_id", str(spec["spec_id"]), *stage_flag,
+                            "--file_prefix", manifest["file_prefix"], "--output_directory", manifest["outdir"],
+                            *shlex.split(main_args)],
+            })
+    return jobs
+
+
+def run_jobs(jobs, sweep_dir, gpus=(), cpu_slots=1):
+    """
+    Run `jobs` on a pool with one slot per GPU of `gpus` (the job sees only this GPU) or, without GPUs,
+    `cpu_slots` slots. Each job logs to `sweep_dir/logs/<job_id>.out`, successes are marked in
+    `sweep_dir/done` and the wall time of every job is appended to `sweep_dir/timings.csv`.
+    """
+    for subdir in ["logs", "done"]:
+        os.makedirs(os.path.join(sweep_dir, subdir), exist_ok=True)
+    slots = queue.Queue()
+    for slot in (list(gpus) or [""] * cpu_slots):
+        slots.put(str(slot))
+    n_workers = slots.qsize()
+    timings_fn = os.path.join(sweep_dir, "timings.csv")
+    timings_lock = threading.Lock()
+
+    def run(job):
+        slot = slots.get()
+        try:
+            print(f">> {job['job_id']} ({job['model_id']}) on {'GPU ' + slot if slot else 'CPU'}")
+            start = datetime.datetime.now()
+            tic = time.monotonic()
+            with open(os.path.join(sweep_dir, "logs", f"{job['job_id']}.out"), "w") as log:
+                returncode = subprocess.run(job["command"], env=dict(os.environ, CUDA_VISIBLE_DEVICES=slot),
+                                            stdout=log, stderr=subprocess.STDOUT).returncode
+            seconds = time.monotonic() - tic
+            if returncode == 0:
+                open(os.path.join(sweep_dir, "done", job["job_id"]), "w").close()
+            else:
+                print(f"EE {job['job_id']} failed with code {returncode}, see its log")
+            timing = pd.DataFrame([{"job_id": job["job_id"], "stage": job["stage"], "spec_id": job["spec_id"],
+                                    "model_id": job["model_id"], "slot": slot or "cpu", "start": start.isoformat(),
+                                    "seconds": seconds, "returncode": returncode}])
+            with timings_lock:
+                timing.to_csv(timings_fn, mode="a", header=not os.path.exists(timings_fn), index=False)
+            return returncode
+        finally:
+            slots.put(slot)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(run, jobs))
+
+
+def parse_ids(ids):
+    return None if not ids else [int(i) for i in ids.split(",")]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("run")
+@click.option("-f", "--file_prefix", "file_prefix", envvar="FILE_PREFIX", type=str, default='test', show_default=True, help="file prefix of the runs, as in main.py")
+@click.option("-d", "--output_directory", "outdir", envvar="OCP_OUTDIR", type=str, default='/work/users/c/h/chadi/influpaint_res/', show_default=True, help="where main.py writes the runs")
+@click.option("--sweep_dir", "sweep_dir", type=str, default=None, help="manifest, logs and timings of the sweep (default: <outdir>sweep-<file_prefix>)")
+@click.option("-t", "--train", "do_training", type=bool, default=True, show_default=True, help="whether to run the training jobs")
+@click.option("-i", "--inpaint", "do_inpainting", type=bool, default=False, show_default=True, help="whether to run the inpainting jobs (after all the trainings)")
+@click.option("-s", "--spec_ids", "spec_ids", type=str, default="", help="comma separated subset of spec ids (default: all)")
+@click.option("-g", "--gpus", "gpus", type=str, default="", help="comma separated GPU ids, one job per GPU at a time")
+@click.option("-c", "--cpu_slots", "cpu_slots", type=int, default=1, show_default=True, help="concurrent jobs without GPUs")
+@click.option("-a", "--main_args", "main_args", type=str, default="", help="extra options given to main.py, e.g '-p bf16 -e 0.999'")
+def run(file_prefix, outdir, sweep_dir, do_training, do_inpainting, spec_ids, gpus, cpu_slots, main_args):
+    """ run the pending jobs of the sweep on this machine """
+    sweep_dir = sweep_dir or f"{outdir}sweep-{file_prefix}"
+    manifest = load_manifest(sweep_dir, file_prefix, outdir)
+    gpus = [g for g in gpus.split(",") if g]
+    for stage, enabled in [("train", do_training), ("inpaint", do_inpainting)]:
+        if not enabled:
+            continue
+        jobs = make_jobs(manifest, [stage], spec_ids=parse_ids(spec_ids), main_args=main_args)
+        pending = [job for job in jobs if not job_done(job, sweep_dir)]
+        print(f">> {stage}: {len(jobs) - len(pending)} of {len(jobs)} jobs already done, running {len(pending)}")
+        run_jobs(pending, sweep_dir, gpus=gpus, cpu_slots=cpu_slots)
+
+
+@cli.command("commands")
+@click.option("-f", "--file_prefix", "file_prefix", envvar="FILE_PREFIX", type=str, default='test', show_default=True, help="file prefix of the runs, as in main.py")
+@click.option("-d", "--output_directory", "outdir", envvar="OCP_OUTDIR", type=str, default='/work/users/c/h/chadi/influpaint_res/', show_default=True, help="where main.py writes the runs")
+@click.option("--sweep_dir", "sweep_dir", type=str, default=None, help="manifest, logs and timings of the sweep (default: <outdir>sweep-<file_prefix>)")
+@click.option("--stage", "stage", type=click.Choice(["train", "inpaint"]), default="train", show_default=True)
+@click.option("-s", "--spec_ids", "spec_ids", type=str, default="", help="comma separated subset of spec ids (default: all)")
+@click.option("-a", "--main_args", "main_args", type=str, default="", help="extra options given to main.py")
+def commands(file_prefix, outdir, sweep_dir, stage, spec_ids, main_args):
+    """
+    print the commands of the pending jobs, one per line, e.g for a SLURM array:
+    `sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" jobs.txt | bash`
+    """
+    sweep_dir = sweep_dir or f"{outdir}sweep-{file_prefix}"
+    manifest = load_manifest(sweep_dir, file_prefix, outdir)
+    for job in make_jobs(manifest, [stage], spec_ids=parse_ids(spec_ids), main_args=main_args):
+        if not job_done(job, sweep_dir):
+            print(shlex.join(job["command"]))
+
+
+if __name__ == '__main__':
+    cli()
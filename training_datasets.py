@@ -1,18 +1,284 @@
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
 import torch
 import xarray as xr
-import data_utils
+import build_dataset
+
+
+SMHR1_netcdf_file = "Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc"
+fluview_csv_file = "Flusight/flu-datasets/fluview.csv"
+
+
+def split_frame_index(idx):
+    """ (positions along the first dimension, remaining index, whether a single frame is selected) """
+    rest = ()
+    if isinstance(idx, tuple):
+        idx, rest = idx[0], idx[1:]
+    if torch.is_tensor(idx):
+        idx = idx.tolist()
+    single = np.ndim(idx) == 0 and not isinstance(idx, slice)
+    return idx, rest, single
+
+
+def finish_frame_index(frames, rest, single):
+    if single:
+        frames = frames[0]
+    if rest:
+        frames = frames[(slice(None),) * (not single) + rest]
+    return frames
+
+
+class NetCDFFrames:
+    """
+    Frames (n_samples, n_features, n_dates, n_places) of a netcdf dataarray, read from disk only when
+    indexed (along the first dimension), so ensembles larger than memory can be used for training.
+    `frame_fn` maps the selected xr.DataArray rows to the frames as an np.array.
+    """
+    def __init__(self, netcdf_file, frame_fn=None):
+        self.netcdf_file = netcdf_file
+        self.frame_fn = frame_fn if frame_fn is not None else (lambda da: da.data)
+        self.da = xr.open_dataarray(netcdf_file)
+        self.shape = (self.da.shape[0],) + self.frame_fn(self.da[:1]).shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        idx, rest, single = split_frame_index(idx)
+        if isinstance(idx, slice):
+            frames = np.asarray(self.frame_fn(self.da[idx]))
+        else:
+            rows, inverse = np.unique(np.atleast_1d(idx), return_inverse=True)
+            frames = np.asarray(self.frame_fn(self.da[rows]))[inverse]
+        return finish_frame_index(frames, rest, single)
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+
+class LazyFrames:
+    """
+    Concatenation of frame sources (np.array, np.memmap or NetCDFFrames) through an index: frame i is
+    row `rows[i]` of source `source_ids[i]`. Repeating and shuffling only permute the index, the
+    frames are read from their source when indexed, one sorted read per source.
+    """
+    def __init__(self, sources, source_ids, rows):
+        self.sources = sources
+        self.source_ids = np.asarray(source_ids)
+        self.rows = np.asarray(rows)
+        self.shape = (len(self.rows),) + tuple(sources[0].shape[1:])
+
+    @classmethod
+    def concatenate(cls, sources, repeats=None, shuffle=False, rng=None):
+        if repeats is None:
+            repeats = [1] * len(sources)
+        source_ids = np.concatenate([np.full(len(src) * rep, i) for i, (src, rep) in enumerate(zip(sources, repeats))])
+        rows = np.concatenate([np.tile(np.arange(len(src)), rep) for src, rep in zip(sources, repeats)])
+        if shuffle:
+            order = (rng if rng is not None else np.random.default_rng()).permutation(len(rows))
+            source_ids, rows = source_ids[order], rows[order]
+        return cls(sources, source_ids, rows)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        idx, rest, single = split_frame_index(idx)
+        positions = np.arange(len(self))[idx] if isinstance(idx, slice) else np.atleast_1d(idx)
+
+        frames = None
+        for source_id in np.unique(self.source_ids[positions]):
+            sel = np.flatnonzero(self.source_ids[positions] == source_id)
+            rows, inverse = np.unique(self.rows[positions[sel]], return_inverse=True)
+            source_frames = np.asarray(self.sources[source_id][rows])
+            if frames is None:
+                frames = np.empty((len(positions),) + self.shape[1:], dtype=source_frames.dtype)
+            frames[sel] = source_frames[inverse]
+        if frames is None:
+            frames = np.empty((0,) + self.shape[1:])
+        return finish_frame_index(frames, rest, single)
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+
+def load_csp_SMHR1(netcdf_file, channels=3, lazy=False):
+    """
+    frames (n_samples, n_features, n_dates, n_places) of a CSP scenario netcdf, FluA + FluB if channels == 1.
+    Loaded in memory, or with `lazy` as NetCDFFrames read from disk when indexed (for ensembles that do
+    not fit in memory: each read is slow, use large batches, e.g BatchedFluLoader).
+    """
+    def frame_fn(flu_dyn):
+        if channels == 1:
+            flu_dyn = flu_dyn.sel(feature="incidH_FluA") + flu_dyn.sel(
+                feature="incidH_FluB"
+            )
+            flu_dyn = flu_dyn.expand_dims("feature", axis=1).assign_coords(
+                feature=("feature", ["incidH"])
+            )
+        return flu_dyn.data
+    frames = NetCDFFrames(netcdf_file, frame_fn=frame_fn)
+    return frames if lazy else np.asarray(frames)
+
+
+def load_synthetic_dataset(netcdf_file, channels=3, lazy=False):
+    """ frames of a synthetic dataset netcdf, keeping the first `channels` features, in memory or `lazy` (see load_csp_SMHR1) """
+    frames = NetCDFFrames(netcdf_file, frame_fn=lambda da: da.data[:, :channels, :, :])
+    return frames if lazy else np.asarray(frames)
+
+
+def load_fluview(season_setup, download=False):
+    """ one frame (1, n_dates, n_places) per fluview season """
+    fluview = build_dataset.get_from_epidata(
+        dataset="fluview", season_setup=season_setup, download=download, write=False
+    )
+    df = fluview[fluview["location_code"].isin(season_setup.locations)]
+    return np.array(build_dataset.dataframe_to_arraylist(df=df, season_setup=season_setup))
+
+
+stats_quantiles = [0.5, 0.9, 0.99]
+
+
+def file_sha256(fn, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cached_file_sha256(source_file):
+    """
+    sha256 of `source_file`, cached in a sidecar `<source_file>.sha256.json` and only recomputed when
+    the size or modification time of the file changed.
+    """
+    sidecar_fn = f"{source_file}.sha256.json"
+    st = os.stat(source_file)
+    if os.path.exists(sidecar_fn):
+        with open(sidecar_fn) as f:
+            cached = json.load(f)
+        if cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+            return cached["sha256"]
+
+    source_hash = file_sha256(source_file)
+    tmp_fn = f"{sidecar_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump({"source": str(source_file), "sha256": source_hash, "size": st.st_size, "mtime_ns": st.st_mtime_ns}, f)
+    os.replace(tmp_fn, sidecar_fn)
+    return source_hash
+
+
+def compute_stats(flu_dyn, chunk_size=1024, max_quantile_frames=2048, seed=0):
+    """
+    per-channel statistics of frames (n_samples, n_features, n_dates, n_places), read `chunk_size`
+    frames at a time so lazy frames are never fully loaded. The quantiles are estimated on at most
+    `max_quantile_frames` randomly chosen frames.
+    """
+    n_samples = len(flu_dyn)
+    max_per_feature, sum_per_feature = None, 0
+    for start in range(0, n_samples, chunk_size):
+        chunk = np.asarray(flu_dyn[start:start + chunk_size])
+        chunk_max = np.max(chunk, axis=(0, 2, 3))
+        max_per_feature = chunk_max if max_per_feature is None else np.maximum(max_per_feature, chunk_max)
+        sum_per_feature = sum_per_feature + np.sum(chunk, axis=(0, 2, 3))
+    n_values = n_samples * np.prod(flu_dyn.shape[2:])
+
+    quantile_idx = np.arange(n_samples)
+    if n_samples > max_quantile_frames:
+        quantile_idx = np.sort(np.random.default_rng(seed).choice(n_samples, size=max_quantile_frames, replace=False))
+    quantile_frames = np.asarray(flu_dyn[quantile_idx])
+    return {
+        "n_samples": int(n_samples),
+        "max_per_feature": max_per_feature.tolist(),
+        "mean_per_feature": (sum_per_feature / n_values).tolist(),
+        "quantiles": stats_quantiles,
+        "quantiles_per_feature": np.quantile(quantile_frames, stats_quantiles, axis=(0, 2, 3)).T.tolist(),
+    }
+
+
+def cached_stats(source_file, load_fn, variant="default"):
+    """
+    Statistics (see compute_stats) of the frames `load_fn()` builds from `source_file`, cached in a
+    sidecar `<source_file>.stats-<variant>.json` next to the source. The cache is keyed on the sha256
+    of the source: it is recomputed when the file changes, and the hash itself is only recomputed
+    when the size or modification time of the file changed.
+    """
+    sidecar_fn = f"{source_file}.stats-{variant}.json"
+    st = os.stat(source_file)
+    cached = None
+    if os.path.exists(sidecar_fn):
+        with open(sidecar_fn) as f:
+            cached = json.load(f)
+        if cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+            return cached["stats"]
+
+    source_hash = cached_file_sha256(source_file)
+    if cached is not None and cached["sha256"] == source_hash:
+        stats = cached["stats"]
+    else:
+        print(f">> computing dataset statistics of {source_file} ({variant})")
+        stats = compute_stats(load_fn())
+
+    tmp_fn = f"{sidecar_fn}.{os.getpid()}.tmp"  # several jobs may fill the same cache
+    with open(tmp_fn, "w") as f:
+        json.dump({"source": str(source_file), "variant": variant, "sha256": source_hash,
+                   "size": st.st_size, "mtime_ns": st.st_mtime_ns, "stats": stats}, f, indent=1)
+    os.replace(tmp_fn, sidecar_fn)
+    return stats
+
+
+# the *_stats functions take the `frames` already loaded by a FluDataset constructor, so that a cache
+# miss does not read the source a second time
+
+def csp_SMHR1_stats(netcdf_file, channels=3, frames=None):
+    return cached_stats(netcdf_file, lambda: load_csp_SMHR1(netcdf_file, channels=channels, lazy=True) if frames is None else frames, variant=f"csp-channels{channels}")
+
+
+def synthetic_dataset_stats(netcdf_file, channels=3, frames=None):
+    return cached_stats(netcdf_file, lambda: load_synthetic_dataset(netcdf_file, channels=channels, lazy=True) if frames is None else frames, variant=f"synthetic-channels{channels}")
+
+
+def fluview_stats(season_setup, frames=None):
+    """
+    Of the fluview csv, not of freshly downloaded data (which is not written to the csv). The frames
+    depend on the locations and on the season start date (the frame boundaries) of the season setup,
+    which are part of the cache key.
+    """
+    setup_hash = hashlib.sha256(
+        f"{pd.Timestamp(season_setup.fluseason_startdate).date()}|{','.join(sorted(map(str, season_setup.locations)))}".encode()
+    ).hexdigest()[:12]
+    return cached_stats(fluview_csv_file, lambda: load_fluview(season_setup=season_setup) if frames is None else frames, variant=f"fluview-{setup_hash}")
+
+
+# descriptions of the sources, for the configuration hashed in the spec manifest (epiframework.spec_grid):
+# a changed source file gives new model hashes
+
+def csp_SMHR1_source(netcdf_file, channels=3):
+    return {"loader": "csp_SMHR1", "file": str(netcdf_file), "sha256": cached_file_sha256(netcdf_file), "channels": channels}
+
+
+def fluview_source(season_setup):
+    return {"loader": "fluview", "file": fluview_csv_file, "sha256": cached_file_sha256(fluview_csv_file),
+            "season_start": str(pd.Timestamp(season_setup.fluseason_startdate).date()),
+            "locations": sorted(map(str, season_setup.locations))}
 
 
 class FluDataset(torch.utils.data.Dataset):
     """
     transform_enrich are for enriching the dataset and are not inverted (thus must have a mean effect of zero).
     """
-    def __init__(self, flu_dyn, transform=None, transform_enrich=None, transform_inv=None, channels=3):
+    def __init__(self, flu_dyn, transform=None, transform_enrich=None, transform_inv=None, channels=3, max_per_feature=None):
         """
         Args:
-            flu_dyn (np.array): flu dynamics, shape (n_samples, n_features, n_dates, n_places)
+            flu_dyn (np.array): flu dynamics, shape (n_samples, n_features, n_dates, n_places),
+                an np.memmap or lazy frames (NetCDFFrames, LazyFrames) read on access,
+                or None for a stats-only handle (see `stats_only`)
+            max_per_feature (np.array): if given, used instead of computing it from flu_dyn
         """
         self.transform = transform
         self.transform_inv = transform_inv
@@ -20,50 +286,50 @@ class FluDataset(torch.utils.data.Dataset):
 
         self.flu_dyn = flu_dyn
         #  self.max_per_feature = self.flu_dyn.max(dim=["date", "place", "sample"])
-        self.max_per_feature = np.max(
-            self.flu_dyn, axis=(0, 2, 3)
-        )  # TODO: Check with channels, also perhaps use keepdims=True for broadcasting
+        if max_per_feature is None:
+            max_per_feature = np.max(
+                self.flu_dyn, axis=(0, 2, 3)
+            )  # TODO: Check with channels, also perhaps use keepdims=True for broadcasting
+        self.max_per_feature = max_per_feature
 
-        print(
-            f"created dataset with max {np.array(self.max_per_feature)}, full dataset has shape {self.flu_dyn.shape}"
+        if self.flu_dyn is None:
+            print(f"created stats-only dataset handle with max {np.array(self.max_per_feature)}")
+        else:
+            print(
+                f"created dataset with max {np.array(self.max_per_feature)}, full dataset has shape {self.flu_dyn.shape}"
+            )
+
+    @classmethod
+    def stats_only(cls, max_per_feature, transform=None, transform_inv=None, channels=3):
+        """
+        Lightweight handle with the scaling statistics and transforms of a dataset but no frames, for
+        inpainting (which only needs `max_per_feature` and apply_transform/apply_transform_inv).
+        Use add_transform(..., bypass_test=True) on it.
+        """
+        return cls(
+            flu_dyn=None,
+            transform=transform,
+            transform_inv=transform_inv,
+            channels=channels,
+            max_per_feature=np.asarray(max_per_feature),
         )
 
     @classmethod
     def from_SMHR1_fluview(
         cls, season_setup, download=False, transform=None, transform_inv=None, channels=3
     ):
-        netcdf_file = (
-            "Flusight/flu-datasets/synthetic/CSP_FluSMHR1_weekly_padded_4scn.nc"
-        )
         channels = 1
-        flu_dyn = xr.open_dataarray(netcdf_file)
-        if channels == 1:
-            flu_dyn = flu_dyn.sel(feature="incidH_FluA") + flu_dyn.sel(
-                feature="incidH_FluB"
-            )
-            flu_dyn = flu_dyn.expand_dims("feature", axis=1).assign_coords(
-                feature=("feature", ["incidH"])
-            )
-        flu_dyn1 = flu_dyn.data
-
-        fluview = data_utils.get_from_epidata(
-            dataset="fluview", season_setup=season_setup, download=download, write=False
-        )
-        df = fluview[fluview["location_code"].isin(season_setup.locations)]
-        flu_dyn2 = np.array(data_utils.dataframe_to_arraylist(df=df, season_setup=season_setup))
-
-        flu_dyn2 = flu_dyn2.repeat(90, axis=0)
+        csp = cls.from_csp_SMHR1(SMHR1_netcdf_file, channels=channels)
+        fluview = cls.from_fluview(season_setup=season_setup, download=download, channels=channels)
+        # same mixture and epoch length as repeating fluview 90 times, without copying it
+        n_fluview = 90 * len(fluview)
         print(
-            f"After repeat, fluview data has shape {flu_dyn2.shape} vs {flu_dyn1.shape} from csp"
+            f"Sampling fluview data as {n_fluview} frames vs {len(csp)} from csp"
         )
-        flu_dyn = np.concatenate((flu_dyn1, flu_dyn2), axis=0)
-
-        rng = np.random.default_rng()
-
-        rng.shuffle(flu_dyn, axis=0)  # this is inplace
-
-        return cls(
-            flu_dyn=flu_dyn,
+        return CompositeFluDataset(
+            [csp, fluview],
+            weights=[len(csp), n_fluview],
+            epoch_size=len(csp) + n_fluview,
             transform=transform,
             transform_inv=transform_inv,
             channels=channels,
@@ -71,34 +337,27 @@ class FluDataset(torch.utils.data.Dataset):
 
     @classmethod
     def from_csp_SMHR1(
-        cls, netcdf_file, transform=None, transform_inv=None, channels=3
+        cls, netcdf_file, transform=None, transform_inv=None, channels=3, lazy=False
     ):
-        flu_dyn = xr.open_dataarray(netcdf_file)
-        if channels == 1:
-            flu_dyn = flu_dyn.sel(feature="incidH_FluA") + flu_dyn.sel(
-                feature="incidH_FluB"
-            )
-            flu_dyn = flu_dyn.expand_dims("feature", axis=1).assign_coords(
-                feature=("feature", ["incidH"])
-            )
-        flu_dyn = flu_dyn.data
+        flu_dyn = load_csp_SMHR1(netcdf_file, channels=channels, lazy=lazy)
         return cls(
             flu_dyn=flu_dyn,
             transform=transform,
             transform_inv=transform_inv,
             channels=channels,
+            max_per_feature=np.array(csp_SMHR1_stats(netcdf_file, channels=channels, frames=flu_dyn)["max_per_feature"]),
         )
     @classmethod
     def from_synthetic_dataset(
-        cls, netcdf_file, transform=None, transform_inv=None, channels=3
+        cls, netcdf_file, transform=None, transform_inv=None, channels=3, lazy=False
     ):
-        flu_dyn = xr.open_dataarray(netcdf_file)
-        flu_dyn = flu_dyn.data[:, :channels, :, :]  # Select the right number of channels
+        flu_dyn = load_synthetic_dataset(netcdf_file, channels=channels, lazy=lazy)  # Select the right number of channels
         return cls(
             flu_dyn=flu_dyn,
             transform=transform,
             transform_inv=transform_inv,
             channels=channels,
+            max_per_feature=np.array(synthetic_dataset_stats(netcdf_file, channels=channels, frames=flu_dyn)["max_per_feature"]),
         )
 
     @classmethod
@@ -113,10 +372,9 @@ class FluDataset(torch.utils.data.Dataset):
             right_on="abbreviation",
             how="left",
         )
-        df["fluseason"] = df["date"].apply(season_setup.get_fluseason_year)
-        df["fluseason_fraction"] = df["date"].apply(season_setup.get_fluseason_fraction)
+        df["fluseason"], df["fluseason_fraction"] = season_setup.get_fluseason_year_fraction(df["date"])
         flu_dyn = np.array(
-            data_utils.dataframe_to_arraylist(
+            build_dataset.dataframe_to_arraylist(
                 df, season_setup=season_setup, value_column="incidH"
             )
         )
@@ -131,17 +389,14 @@ class FluDataset(torch.utils.data.Dataset):
     def from_fluview(
         cls, season_setup, download=False, transform=None, transform_inv=None, channels=3
     ):
-        fluview = data_utils.get_from_epidata(
-            dataset="fluview", season_setup=season_setup, download=download, write=False
-        )
-        df = fluview[fluview["location_code"].isin(season_setup.locations)]
-        flu_dyn = np.array(data_utils.dataframe_to_arraylist(df=df, season_setup=season_setup))
+        flu_dyn = load_fluview(season_setup=season_setup, download=download)
 
         return cls(
             flu_dyn=flu_dyn,
             transform=transform,
             transform_inv=transform_inv,
             channels=channels,
+            max_per_feature=None if download else np.array(fluview_stats(season_setup=season_setup, frames=flu_dyn)["max_per_feature"]),
         )
 
     def add_transform(self, transform, transform_inv, transform_enrich, bypass_test=False):
@@ -204,3 +459,94 @@ class FluDataset(torch.utils.data.Dataset):
             np.abs(self.apply_transform_inv(epi_frame_n) - self.flu_dyn[idx]) < 1e-5
         ).all()
         print("test passed: back and forth transformation are ok ✅")
+
+
+class CompositeFluDataset(FluDataset):
+    """
+    Mix of FluDataset sources, drawn with the per-source probabilities `weights` (normalized) by
+    `sampler()`, with `epoch_size` draws per epoch (default: the total number of frames). The frames are
+    not copied, they are read from the sources through a LazyFrames index; the transforms are the
+    ones of the composite (add_transform), not of the sources.
+    """
+    def __init__(self, sources, weights=None, epoch_size=None, transform=None, transform_enrich=None, transform_inv=None, channels=3):
+        self.sources = sources
+        weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=float)
+        self.weights = weights / weights.sum()
+        self.epoch_size = epoch_size if epoch_size is not None else sum(len(src) for src in sources)
+        super().__init__(
+            flu_dyn=LazyFrames.concatenate([src.flu_dyn for src in sources]),
+            transform=transform,
+            transform_enrich=transform_enrich,
+            transform_inv=transform_inv,
+            channels=channels,
+            max_per_feature=np.max([src.max_per_feature for src in sources], axis=0),
+        )
+
+    def frame_weights(self):
+        """ sampling probability of each frame of the concatenation """
+        return np.concatenate([np.full(len(src), w / len(src)) for src, w in zip(self.sources, self.weights)])
+
+    def sampler(self, generator=None, num_samples=None):
+        """ to give to a DataLoader instead of shuffle=True, `epoch_size` draws by default """
+        return torch.utils.data.WeightedRandomSampler(
+            self.frame_weights(), num_samples=num_samples or self.epoch_size, replacement=True, generator=generator
+        )
+
+
+class BatchedFluLoader:
+    """
+    Iterate over shuffled batches of a FluDataset, holding the frames as a single tensor on `device`
+    and applying batched transforms (see epiframework.batch_transform_library) to whole batches
+    instead of calling FluDataset.__getitem__ frame by frame. Can be given to DDPM.train in place
+    of a DataLoader. The frames are loaded in memory, use a DataLoader for lazy frames that do not fit.
+    With `world_size` > 1 (distributed training), each process iterates over its `rank` shard of
+    an order that is the same on every process (seeded with `seed` and the epoch, see set_epoch).
+    """
+    def __init__(self, dataset, batch_size, device="cpu", transform=None, transform_enrich=None, shuffle=True, drop_last=True, rank=0, world_size=1, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.transform = transform
+        self.transform_enrich = transform_enrich
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+        self.flu_dyn = torch.as_tensor(np.asarray(dataset.flu_dyn), dtype=torch.float32, device=device)
+        # a CompositeFluDataset is drawn with its source weights instead of shuffled
+        self.frame_weights = None
+        self.n_frames = len(self.flu_dyn)
+        if isinstance(dataset, CompositeFluDataset):
+            self.frame_weights = torch.as_tensor(dataset.frame_weights(), dtype=torch.float32, device=device)
+            self.n_frames = dataset.epoch_size
+        self.n_frames = self.n_frames // world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_frames // self.batch_size
+        return -(-self.n_frames // self.batch_size)
+
+    def __iter__(self):
+        generator = None
+        if self.world_size > 1:
+            generator = torch.Generator(device=self.device).manual_seed(self.seed + self.epoch)
+        if self.frame_weights is not None:
+            order = torch.multinomial(self.frame_weights, self.n_frames * self.world_size, replacement=True, generator=generator)
+        elif self.shuffle:
+            order = torch.randperm(len(self.flu_dyn), device=self.device, generator=generator)
+        else:
+            order = torch.arange(len(self.flu_dyn), device=self.device)
+        order = order[self.rank::self.world_size]
+        for i in range(len(self)):
+            batch = self.flu_dyn[order[i * self.batch_size:(i + 1) * self.batch_size]]
+            if self.transform_enrich:
+                batch = self.transform_enrich(batch)
+            if self.transform:
+                batch = self.transform(batch)
+            yield batch.float()
@@ -75,3 +75,64 @@ def transform_skewednoise(image, scale=0.4, a=-1):
 
 def transform_poisson(image):
     return np.random.poisson(image)
+
+
+# Batched versions of the transforms above, applied to a whole torch tensor with dimensions
+#  (sample, feature, date, place), optionally on the training device. Random parameters
+#  are drawn independently for each sample of the batch.
+
+
+def batch_channelwisescale(batch, scale):
+    import torch
+
+    scale = torch.as_tensor(scale, dtype=batch.dtype, device=batch.device).reshape(1, -1, 1, 1)
+    return batch * scale
+
+
+def batch_channelwisescale_inv(batch, scale):
+    import torch
+
+    scale = torch.as_tensor(scale, dtype=batch.dtype, device=batch.device).reshape(1, -1, 1, 1)
+    return batch / scale
+
+
+def batch_sqrt(batch):
+    return batch.sqrt()
+
+
+def batch_sqrt_inv(batch):
+    return batch ** 2
+
+
+def batch_randomscale(batch, max, min, generator=None):
+    import torch
+
+    scale = torch.rand((batch.shape[0], 1, 1, 1), device=batch.device, generator=generator)
+    return batch * (min + (max - min) * scale).to(batch.dtype)
+
+
+def batch_random_padintime(batch, min_shift, max_shift, neutral_value=0, generator=None):
+    import torch
+
+    n_dates = batch.shape[2]
+    shift = torch.randint(min_shift, max_shift + 1, (batch.shape[0], 1), device=batch.device, generator=generator)
+    dates = torch.arange(n_dates, device=batch.device).unsqueeze(0)
+    # roll each sample by its own shift, then pad what was rolled over
+    src = ((dates - shift) % n_dates).reshape(batch.shape[0], 1, n_dates, 1).expand_as(batch)
+    r_val = batch.gather(2, src)
+    pad = ((dates < shift) | (dates >= n_dates + shift)).reshape(batch.shape[0], 1, n_dates, 1)
+    return r_val.masked_fill(pad, neutral_value)
+
+
+def batch_randomnoise(batch, sigma=0.2, generator=None):
+    import torch
+
+    mu = 1
+    noise = torch.randn(batch.shape, device=batch.device, generator=generator, dtype=batch.dtype)
+    return batch * (mu + sigma * noise)
+
+
+def batch_poisson(batch, generator=None):
+    import torch
+
+    return torch.poisson(batch.clamp(min=0), generator=generator)
@@ -0,0 +1,69 @@
+import os
+import functools
+
+import numpy as np
+import pandas as pd
+
+
+# dataset -> (data repository as pulled by update-data.sh, branch, truth csv in the repository). The
+# working copy of the same file is read when no vintage is asked (build_dataset.flusight_truth_files),
+# so both paths parse the same table. For 2023-24 this is the live target-data file: the dated
+# archives of auxiliary-data are snapshots of it and do not exist in earlier commits.
+truth_repos = {
+    "flusight2022_23": ("Flusight/2022-2023/FluSight-forecast-hub-official/", "master", "data-truth/truth-Incident Hospitalizations.csv"),
+    "flusight2023_24": ("Flusight/2023-2024/FluSight-forecast-hub-official/", "main", "target-data/target-hospital-admissions.csv"),
+}
+
+
+class VintageIndex:
+    """
+    Date -> commit table of the history of `branch` in a data repository, to read files as they were
+    committed at a given date directly from the git objects: nothing is checked out, so any number of
+    jobs can read vintages of the same repository concurrently. The table is built with one walk of the
+    history and stored in `cache_dir`, keyed on the commit at the tip of the branch (it is rebuilt
+    when the branch moves, e.g after update-data.sh).
+    """
+    def __init__(self, repo_path, branch, cache_dir="Flusight/flu-datasets/vintage-index"):
+        import pygit2
+        self.repo_path = repo_path
+        self.repo = pygit2.Repository(repo_path)
+        tip = self.repo.lookup_reference(f"refs/heads/{branch}").target
+
+        index_fn = os.path.join(cache_dir, f"{os.path.basename(os.path.normpath(repo_path))}-{tip}.csv")
+        if os.path.exists(index_fn):
+            self.index = pd.read_csv(index_fn)
+        else:
+            self.index = pd.DataFrame(
+                [(commit.commit_time, str(commit.id)) for commit in self.repo.walk(tip, pygit2.GIT_SORT_TIME)],
+                columns=["commit_time", "sha"],
+            ).sort_values("commit_time", kind="stable", ignore_index=True)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_fn = f"{index_fn}.{os.getpid()}.tmp"
+            self.index.to_csv(tmp_fn, index=False)
+            os.replace(tmp_fn, index_fn)
+
+    def commit_for(self, date):
+        """ sha of the last commit made at or before `date` """
+        i = np.searchsorted(self.index["commit_time"].to_numpy(), date.timestamp(), side="right") - 1
+        if i < 0:
+            raise ValueError(f"No commit found for {date} on repo {self.repo_path}")
+        return self.index["sha"].iloc[i]
+
+    def read_file(self, path, date):
+        """ content (bytes) of `path` in the commit of `date` """
+        commit = self.repo[self.commit_for(date)]
+        return self.repo[commit.tree[path].id].data
+
+
+@functools.lru_cache(maxsize=None)
+def get_vintage_index(dataset):
+    repo_path, branch, _ = truth_repos[dataset]
+    return VintageIndex(repo_path, branch)
+
+
+def truth_vintage(dataset, date):
+    """ the truth csv (bytes) of a flusight dataset as it was available at `date` """
+    index = get_vintage_index(dataset)
+    sha = index.commit_for(date)
+    print(f"Reading {dataset} truth on {date} from commit {sha} of repo {index.repo_path}")
+    return index.read_file(truth_repos[dataset][2], date)